@@ -9,7 +9,10 @@ def main():
     """Start everything."""
     log_format = "%(asctime)s - %(name)s - %(lineno)d - %(levelname)s - %(message)s"
     logging.basicConfig(level=50 - 10 * conf.VERBOSE, format=log_format)
-    app.run()
+    if conf.WORKERS > 1:
+        app.supervise()
+    else:
+        app.run()
 
 
 if __name__ == "__main__":
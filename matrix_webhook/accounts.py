@@ -0,0 +1,137 @@
+"""Matrix Webhook bot accounts.
+
+Homeservers rate limit each user, so more bot accounts can be given in conf.ACCOUNTS,
+besides the main one. Rooms are assigned to accounts by consistent hashing, so that
+adding an account only moves a few rooms, and a room sticks to the account which posts
+there. When this account is rate limited or logged out, another one takes the room.
+"""
+
+import bisect
+import hashlib
+import logging
+import time
+
+from nio import AsyncClientConfig
+
+from . import conf, metrics, ratelimit, session
+
+LOGGER = logging.getLogger("matrix_webhook.accounts")
+VNODES = 64  # points of each account on the hash ring
+DOWN_DELAY = 60  # seconds before trying again an account which can't log in
+ACCOUNTS = []
+RING = []  # sorted (point, index in ACCOUNTS)
+ROOMS = {}  # room_id -> Account posting there
+FAILOVERS = metrics.Counter(
+    "matrix_webhook_account_failovers_total",
+    "Rooms moved to another bot account, as theirs was rate limited or logged out.",
+)
+metrics.Gauge(
+    "matrix_webhook_accounts_available",
+    "Bot accounts logged in, and not rate limited.",
+    function=lambda: sum(account.available() for account in ACCOUNTS),
+)
+
+
+class Account:
+    """A bot account, with its own session, joined rooms and rate limits."""
+
+    def __init__(self, user_id, password=None, token=None):
+        """Create the client of an account, which logs in with a password or a token."""
+        # rate limits and retries are handled by us, in the ratelimit and retry modules
+        self.client = session.Client(
+            conf.MATRIX_URL,
+            user_id,
+            config=AsyncClientConfig(
+                max_limit_exceeded=0,
+                max_timeouts=0,
+                request_timeout=conf.HTTP_TIMEOUT,
+            ),
+            proxy=conf.PROXY,
+        )
+        self.user_id = user_id
+        self.password = password
+        self.token = token
+        self.joined_rooms = {}  # room_id -> time.monotonic() of the last join
+        self.login = None  # running login task, shared by all the requests needing it
+        self.refresh_token = None
+        self.refresher = None  # timer renewing the access token before it expires
+        self.down_until = 0  # time.monotonic() until which the account can't log in
+        self.bucket = ratelimit.TokenBucket(
+            user_id,
+            conf.RATE_LIMIT,
+            conf.RATE_LIMIT_BURST,
+        )
+        # homeservers limit joins separately
+        self.joins = ratelimit.TokenBucket(f"{user_id} joins")
+
+    def available(self):
+        """Check if the account is logged in, and not rate limited."""
+        return max(self.down_until, self.bucket.blocked_until) <= time.monotonic()
+
+    def down(self):
+        """Leave the account aside for a while, as it can't log in."""
+        msg = f"Account {self.user_id} is logged out, not using it for {DOWN_DELAY}s"
+        LOGGER.error(msg)
+        self.down_until = time.monotonic() + DOWN_DELAY
+
+
+def point(key):
+    """Place a key on the hash ring."""
+    return int.from_bytes(hashlib.blake2b(key.encode(), digest_size=8).digest(), "big")
+
+
+def add(user_id, password=None, token=None):
+    """Add a bot account to the pool."""
+    account = Account(user_id, password, token)
+    ACCOUNTS.append(account)
+    for vnode in range(VNODES):
+        bisect.insort(RING, (point(f"{user_id} {vnode}"), len(ACCOUNTS) - 1))
+    return account
+
+
+def candidates(room_id):
+    """List the accounts in the order they should take a room."""
+    start = bisect.bisect(RING, (point(room_id),))
+    ordered = []
+    for _, index in RING[start:] + RING[:start]:
+        if ACCOUNTS[index] not in ordered:
+            ordered.append(ACCOUNTS[index])
+            if len(ordered) == len(ACCOUNTS):
+                break
+    return ordered
+
+
+def pick(room_id):
+    """Get the account posting to a room, and fail over if it is not available."""
+    current = ROOMS.get(room_id)
+    if current is not None and (current.available() or len(ACCOUNTS) == 1):
+        return current
+    ordered = candidates(room_id)
+    if current is None:
+        # an account already in the room keeps it, eg. after --prime-joined-rooms
+        ordered.sort(key=lambda account: room_id not in account.joined_rooms)
+    account = next(
+        (account for account in ordered if account.available()),
+        current or ordered[0],
+    )
+    if current is not None and account is not current:
+        FAILOVERS.inc()
+        msg = f"Moving {room_id=} from {current.user_id} to {account.user_id}"
+        LOGGER.warning(msg)
+    ROOMS[room_id] = account
+    return account
+
+
+def spare(account):
+    """Check if another account is available to take over from this one."""
+    return any(other.available() for other in ACCOUNTS if other is not account)
+
+
+def first_available():
+    """Get any account able to make a request not related to a room."""
+    return next((account for account in ACCOUNTS if account.available()), MAIN)
+
+
+MAIN = add(conf.MATRIX_ID, conf.MATRIX_PW, conf.MATRIX_TOKEN)
+for extra in conf.ACCOUNTS:
+    add(extra["user_id"], extra.get("password"), extra.get("token"))
@@ -2,42 +2,82 @@
 
 import asyncio
 import logging
+import os
+import signal
+import socket
+import tempfile
+import time
 from pathlib import Path
 from signal import SIGINT, SIGTERM
 
 from aiohttp import web
 
-from . import conf, handler, utils
+try:
+    import uvloop
+except ImportError:  # pragma: no cover
+    uvloop = None
+
+from . import (
+    accounts,
+    coalesce,
+    conf,
+    delivery,
+    edits,
+    formatters,
+    handler,
+    session,
+    utils,
+)
 
 LOGGER = logging.getLogger("matrix_webhook.app")
+BACKLOG = 128  # connections waiting to be accepted by a worker
+MIN_UPTIME = 1  # seconds, don't restart workers crashing faster than this in a loop
 
 
-async def main(event):
+async def main(event, sock=None):
     """Launch main coroutine.
 
-    matrix client login & start web server
+    matrix client login & start web server, on the socket of the supervisor if any
     """
-    if conf.MATRIX_PW:
-        msg = f"Log in {conf.MATRIX_ID=} on {conf.MATRIX_URL=}"
-        LOGGER.info(msg)
-        await utils.CLIENT.login(conf.MATRIX_PW)
+    formatters.load_plugins()
+
+    for account in accounts.ACCOUNTS:
+        session.create(account)
+        if conf.HTTP_WARMUP:
+            await session.warm_up(account)
+        if account.password:
+            await utils.login(account)
+        else:
+            msg = f"Restoring log in {account.user_id=} on {conf.MATRIX_URL=}"
+            LOGGER.info(msg)
+            account.client.access_token = account.token
+
+        if conf.PRIME_JOINED_ROOMS:
+            await utils.prime_joined_rooms(account)
+
+    if conf.EDIT_ALERTS and conf.EDITS_FILE:
+        edits.load()
+
+    if conf.ASYNC_DELIVERY:
+        await delivery.start()
+
+    if conf.ACCESS_LOG:
+        server = web.Server(handler.matrix_webhook)
     else:
-        msg = f"Restoring log in {conf.MATRIX_ID=} on {conf.MATRIX_URL=}"
-        LOGGER.info(msg)
-        utils.CLIENT.access_token = conf.MATRIX_TOKEN
-
-    server = web.Server(handler.matrix_webhook)
+        server = web.Server(handler.matrix_webhook, access_log=None)
     runner = web.ServerRunner(server)
     await runner.setup()
     msg = f"Binding on {conf.SERVER_ADDRESS=}"
     LOGGER.info(msg)
-    if conf.SERVER_PATH:
+    if sock is not None:
+        site = web.SockSite(runner, sock)
+    elif conf.SERVER_PATH:
         site = web.UnixSite(runner, conf.SERVER_PATH)
     else:
         site = web.TCPSite(runner, *conf.SERVER_ADDRESS)
     await site.start()
 
-    if conf.SERVER_PATH:
+    if conf.SERVER_PATH and sock is None:
         Path(conf.SERVER_PATH).chmod(0o664)
 
     # Run until we get a shutdown request
@@ -45,7 +85,11 @@ async def main(event):
 
     # Cleanup
     await runner.cleanup()
-    await utils.CLIENT.close()
+    await coalesce.stop()
+    await delivery.stop()
+    edits.save()
+    for account in accounts.ACCOUNTS:
+        await account.client.close()
 
 
 def terminate(event, signal):
@@ -54,16 +98,118 @@ def terminate(event, signal):
     asyncio.get_event_loop().remove_signal_handler(signal)
 
 
-def run():
+def new_event_loop():
+    """Create the event loop, with uvloop if asked and installed."""
+    if conf.LOOP == "uvloop":
+        if uvloop is not None:
+            return uvloop.new_event_loop()
+        LOGGER.warning("uvloop is not installed, using the asyncio event loop")
+    return asyncio.new_event_loop()
+
+
+def run(sock=None):
     """Launch everything."""
     LOGGER.info("Starting...")
-    loop = asyncio.get_event_loop()
+    loop = new_event_loop()
+    asyncio.set_event_loop(loop)
     event = asyncio.Event()
 
     for sig in (SIGINT, SIGTERM):
         loop.add_signal_handler(sig, terminate, event, sig)
 
-    loop.run_until_complete(main(event))
+    loop.run_until_complete(main(event, sock))
 
     LOGGER.info("Closing...")
     loop.close()
+
+
+def listen():
+    """Open the socket shared by the workers."""
+    if conf.SERVER_PATH:
+        sock = socket.socket(socket.AF_UNIX)
+        sock.bind(conf.SERVER_PATH)
+        Path(conf.SERVER_PATH).chmod(0o664)
+        sock.listen(BACKLOG)
+        return sock
+    host, port = conf.SERVER_ADDRESS
+    if not host and socket.has_dualstack_ipv6():
+        return socket.create_server(
+            ("", port),
+            family=socket.AF_INET6,
+            backlog=BACKLOG,
+            dualstack_ipv6=True,
+        )
+    return socket.create_server((host, port), backlog=BACKLOG)
+
+
+def spawn(sock):
+    """Fork a worker, which serves on sock until it gets SIGTERM."""
+    pid = os.fork()
+    if pid:
+        return pid
+    code = 1
+    try:
+        for sig in (SIGINT, SIGTERM):
+            signal.signal(sig, signal.SIG_DFL)
+        # blocked by the supervisor while forking
+        signal.pthread_sigmask(signal.SIG_UNBLOCK, {SIGINT, SIGTERM})
+        run(sock)
+        code = 0
+    except Exception:
+        LOGGER.exception("Worker crashed")
+    finally:
+        logging.shutdown()
+        os._exit(code)
+
+
+def supervise():
+    """Run conf.WORKERS processes, restart those which crash, and stop them together.
+
+    The workers share the listening socket, and an access token through a file.
+    """
+    msg = f"Binding on {conf.SERVER_ADDRESS=} for {conf.WORKERS} workers"
+    LOGGER.info(msg)
+    sock = listen()
+    fd, utils.TOKEN_FILE = tempfile.mkstemp(prefix="matrix_webhook_", suffix=".json")
+    os.close(fd)
+    workers = {}  # pid -> start time
+    stopping = False
+
+    def stop(sig, _frame):
+        nonlocal stopping
+        stopping = True
+        for pid in workers:
+            os.kill(pid, sig)
+
+    def start():
+        # no signal between checking stopping and adding the new worker
+        signal.pthread_sigmask(signal.SIG_BLOCK, {SIGINT, SIGTERM})
+        try:
+            if not stopping:
+                workers[spawn(sock)] = time.monotonic()
+        finally:
+            signal.pthread_sigmask(signal.SIG_UNBLOCK, {SIGINT, SIGTERM})
+
+    for sig in (SIGINT, SIGTERM):
+        signal.signal(sig, stop)
+
+    try:
+        for _ in range(conf.WORKERS):
+            start()
+        while workers:
+            pid, status = os.wait()
+            started = workers.pop(pid)
+            if stopping:
+                continue
+            msg = f"Worker {pid} stopped unexpectedly, with {status=}. Restarting it."
+            LOGGER.error(msg)
+            if time.monotonic() - started < MIN_UPTIME:
+                time.sleep(MIN_UPTIME)
+            # we might have been asked to stop meanwhile
+            start()
+    finally:
+        sock.close()
+        Path(utils.TOKEN_FILE).unlink()
+        if conf.SERVER_PATH:
+            Path(conf.SERVER_PATH).unlink()
+    LOGGER.info("Closing...")
@@ -0,0 +1,127 @@
+"""Matrix Webhook alert storms coalescing.
+
+When coalescing is enabled for a room or a formatter, the first message opens a window
+of a few seconds for this room and formatter. Messages arriving in this window are
+merged into a single digest, grouped by status and rule, which is sent when the window
+closes, or as soon as it holds conf.COALESCE_MAX messages. Each distinct body is kept,
+with the number of times it was received.
+"""
+
+import asyncio
+import logging
+import math
+from collections import OrderedDict
+
+from . import conf, metrics
+
+LOGGER = logging.getLogger("matrix_webhook.coalesce")
+WINDOWS = {}  # (room_id, formatter) -> Window
+TASKS = set()  # digests being sent
+COALESCED = metrics.Counter(
+    "matrix_webhook_coalesced_total",
+    "Messages merged in a digest.",
+)
+DIGESTS = metrics.Counter(
+    "matrix_webhook_digests_total",
+    "Digests sent.",
+)
+
+
+class Window:
+    """Messages waiting to be sent as a digest in a room."""
+
+    def __init__(self, send):
+        """Open the window: `send(room_id, formatter, body)` will get the digest."""
+        self.send = send
+        self.groups = OrderedDict()  # (status, rule) -> {body: times received}
+        self.count = 0
+        self.timer = None
+
+
+def window(query, formatter):
+    """Get the coalescing window of a webhook, in seconds, or 0 if disabled.
+
+    The `coalesce` query parameter comes first, then the formatter policy.
+    Raise a ValueError if the query parameter is not a number up to
+    conf.MAX_COALESCE_WINDOW.
+    """
+    if "coalesce" in query:
+        seconds = float(query["coalesce"])
+        if not math.isfinite(seconds) or seconds > conf.MAX_COALESCE_WINDOW:
+            msg = f"coalesce window out of range: {seconds}"
+            raise ValueError(msg)
+        return seconds
+    return conf.COALESCE_POLICY.get(formatter, conf.COALESCE_WINDOW)
+
+
+def group(data):
+    """Get the status and the rule of a message, eg. from Grafana."""
+    status = data.get("state") or data.get("status") or ""
+    rule = data.get("ruleName") or data.get("title") or ""
+    if not rule:
+        rule = str(data["body"]).strip().split("\n", 1)[0]
+    return str(status), str(rule)
+
+
+def add(room_id, formatter, data, seconds, send):
+    """Keep a message for the digest of this room and formatter."""
+    key = (room_id, formatter)
+    if key not in WINDOWS:
+        msg = f"Coalescing messages for {room_id=} {formatter=} for {seconds}s"
+        LOGGER.debug(msg)
+        WINDOWS[key] = Window(send)
+        WINDOWS[key].timer = asyncio.get_event_loop().call_later(seconds, flush, key)
+    pending = WINDOWS[key]
+    bodies = pending.groups.setdefault(group(data), {})
+    body = str(data["body"])
+    bodies[body] = bodies.get(body, 0) + 1
+    pending.count += 1
+    if pending.count >= conf.COALESCE_MAX:
+        flush(key)
+
+
+def heading(status, rule):
+    """Get the markdown heading of a group of messages in a digest."""
+    title = " ".join(": ".join(part for part in (status, rule) if part).split())
+    return f"### {title}" if title else None
+
+
+def digest(pending):
+    """Merge the messages of a window into a single markdown body.
+
+    There is one heading for each status and rule.
+    """
+    if pending.count == 1:
+        return next(iter(next(iter(pending.groups.values()))))
+    parts = [f"**{pending.count} notifications**"]
+    for (status, rule), bodies in pending.groups.items():
+        title = heading(status, rule)
+        if title is not None:
+            parts.append(title)
+        for body, times in bodies.items():
+            parts.append(body.strip())
+            if times > 1:
+                parts.append(f"*({times} times)*")
+    return "\n\n".join(parts)
+
+
+def flush(key):
+    """Close a window, and send its digest."""
+    pending = WINDOWS.pop(key)
+    pending.timer.cancel()
+    room_id, formatter = key
+    msg = f"Sending a digest of {pending.count} messages in {room_id=}"
+    LOGGER.info(msg)
+    COALESCED.inc(pending.count)
+    DIGESTS.inc()
+    task = asyncio.ensure_future(pending.send(room_id, formatter, digest(pending)))
+    TASKS.add(task)
+    task.add_done_callback(TASKS.discard)
+
+
+async def stop():
+    """Send all the pending digests now."""
+    for key in list(WINDOWS):
+        flush(key)
+    if TASKS:
+        await asyncio.gather(*TASKS, return_exceptions=True)
@@ -0,0 +1,35 @@
+"""Matrix Webhook JSON codec.
+
+orjson is used if it is installed, as it is much faster and parses bytes directly.
+Otherwise, this falls back to the standard library.
+"""
+
+import json
+
+try:
+    import orjson
+except ImportError:  # pragma: no cover
+    orjson = None
+
+BACKEND = "orjson" if orjson is not None else "json"
+
+
+def loads(data):
+    """Parse JSON from bytes or str.
+
+    orjson is stricter than the standard library (eg. on NaN), so it falls back to
+    the standard library instead of rejecting what we used to accept.
+    """
+    if orjson is not None:
+        try:
+            return orjson.loads(data)
+        except orjson.JSONDecodeError:
+            pass
+    return json.loads(data)
+
+
+def dumps(obj):
+    """Serialize to JSON bytes."""
+    if orjson is not None:
+        return orjson.dumps(obj)
+    return json.dumps(obj).encode()
@@ -1,7 +1,10 @@
 """Configuration for Matrix Webhook."""
 
 import argparse
+import json
+import math
 import os
+from pathlib import Path
 
 parser = argparse.ArgumentParser(description=__doc__, prog="python -m matrix_webhook")
 parser.add_argument(
@@ -23,6 +26,13 @@ parser.add_argument(
     default=os.environ.get("PORT", 4785),
     help="port to listed to. Default: 4785. Environment variable: `PORT`",
 )
+parser.add_argument(
+    "--workers",
+    type=int,
+    default=os.environ.get("WORKERS", "1"),
+    help="number of processes sharing the listening socket and the access token. "
+    "Default: 1. Environment variable: `WORKERS`",
+)
 parser.add_argument(
     "-u",
     "--matrix-url",
@@ -79,12 +89,350 @@ parser.add_argument(
     default=os.environ.get("PROXY", None),
     help="The proxy that should be used for the HTTP connection. Environment variable: `PROXY`",
 )
+parser.add_argument(
+    "--loop",
+    choices=["asyncio", "uvloop"],
+    default=os.environ.get("LOOP", "asyncio"),
+    help="event loop, uvloop being used only if it is installed. "
+    "Default: asyncio. Environment variable: `LOOP`",
+)
+parser.add_argument(
+    "--no-access-log",
+    action="store_true",
+    default="NO_ACCESS_LOG" in os.environ,
+    help="don't log each HTTP request. Environment variable: `NO_ACCESS_LOG`",
+)
+parser.add_argument(
+    "--accounts",
+    default=os.environ.get("ACCOUNTS", ""),
+    help="JSON file listing more bot accounts, as "
+    '`[{"user_id": "…", "password": "…"}]` or with a "token" instead of a password. '
+    "Default: `''`. Environment variable: `ACCOUNTS`",
+)
+parser.add_argument(
+    "--http-pool-size",
+    type=int,
+    default=os.environ.get("HTTP_POOL_SIZE", "100"),
+    help="connections to the homeserver per bot account. "
+    "Default: 100. Environment variable: `HTTP_POOL_SIZE`",
+)
+parser.add_argument(
+    "--http-keepalive",
+    type=float,
+    default=os.environ.get("HTTP_KEEPALIVE", "60"),
+    help="seconds during which idle connections to the homeserver are kept open. "
+    "Default: 60. Environment variable: `HTTP_KEEPALIVE`",
+)
+parser.add_argument(
+    "--http-dns-ttl",
+    type=int,
+    default=os.environ.get("HTTP_DNS_TTL", "300"),
+    help="seconds during which the address of the homeserver is cached. "
+    "0 to disable. Default: 300. Environment variable: `HTTP_DNS_TTL`",
+)
+parser.add_argument(
+    "--http-timeout",
+    type=float,
+    default=os.environ.get("HTTP_TIMEOUT", "60"),
+    help="seconds for a whole request to the homeserver. 0 to disable. "
+    "Default: 60. Environment variable: `HTTP_TIMEOUT`",
+)
+parser.add_argument(
+    "--http-connect-timeout",
+    type=float,
+    default=os.environ.get("HTTP_CONNECT_TIMEOUT", "10"),
+    help="seconds to get a connection to the homeserver. 0 to disable. "
+    "Default: 10. Environment variable: `HTTP_CONNECT_TIMEOUT`",
+)
+parser.add_argument(
+    "--http-read-timeout",
+    type=float,
+    default=os.environ.get("HTTP_READ_TIMEOUT", "30"),
+    help="seconds to wait for data from the homeserver. 0 to disable. "
+    "Default: 30. Environment variable: `HTTP_READ_TIMEOUT`",
+)
+parser.add_argument(
+    "--http-warmup",
+    type=int,
+    default=os.environ.get("HTTP_WARMUP", "2"),
+    help="connections opened to the homeserver at startup, per bot account. "
+    "Default: 2. Environment variable: `HTTP_WARMUP`",
+)
+parser.add_argument(
+    "--joined-rooms-ttl",
+    type=float,
+    default=os.environ.get("JOINED_ROOMS_TTL", "3600"),
+    help="seconds during which a joined room is not joined again. 0 to disable. "
+    "Default: 3600. Environment variable: `JOINED_ROOMS_TTL`",
+)
+parser.add_argument(
+    "--prime-joined-rooms",
+    action="store_true",
+    default="PRIME_JOINED_ROOMS" in os.environ,
+    help="fill the joined rooms cache from the homeserver at startup. "
+    "Environment variable: `PRIME_JOINED_ROOMS`",
+)
+parser.add_argument(
+    "--alias-ttl",
+    type=float,
+    default=os.environ.get("ALIAS_TTL", "3600"),
+    help="seconds during which a room alias is not resolved again. 0 to disable. "
+    "Default: 3600. Environment variable: `ALIAS_TTL`",
+)
+parser.add_argument(
+    "--alias-negative-ttl",
+    type=float,
+    default=os.environ.get("ALIAS_NEGATIVE_TTL", "60"),
+    help="seconds during which an unknown room alias is not resolved again. "
+    "Default: 60. Environment variable: `ALIAS_NEGATIVE_TTL`",
+)
+parser.add_argument(
+    "--forbidden-ttl",
+    type=float,
+    default=os.environ.get("FORBIDDEN_TTL", "60"),
+    help="seconds during which a room where the bot is forbidden is not tried again, "
+    "doubled after each failure. 0 to disable. "
+    "Default: 60. Environment variable: `FORBIDDEN_TTL`",
+)
+parser.add_argument(
+    "--forbidden-max-ttl",
+    type=float,
+    default=os.environ.get("FORBIDDEN_MAX_TTL", "3600"),
+    help="maximum seconds during which a room where the bot is forbidden is not "
+    "tried again. Default: 3600. Environment variable: `FORBIDDEN_MAX_TTL`",
+)
+parser.add_argument(
+    "--max-body-size",
+    type=int,
+    default=os.environ.get("MAX_BODY_SIZE", str(1024**2)),
+    help="maximum size of a request body, in bytes. "
+    "Default: 1048576. Environment variable: `MAX_BODY_SIZE`",
+)
+parser.add_argument(
+    "--fanout-concurrency",
+    type=int,
+    default=os.environ.get("FANOUT_CONCURRENCY", "10"),
+    help="maximum rooms delivered at once for a message to many rooms, or a batch. "
+    "Default: 10. Environment variable: `FANOUT_CONCURRENCY`",
+)
+parser.add_argument(
+    "--markdown-cache-size",
+    type=int,
+    default=os.environ.get("MARKDOWN_CACHE_SIZE", "1024"),
+    help="number of rendered markdown bodies to keep. 0 to disable. "
+    "Default: 1024. Environment variable: `MARKDOWN_CACHE_SIZE`",
+)
+parser.add_argument(
+    "--markdown-thread-threshold",
+    type=int,
+    default=os.environ.get("MARKDOWN_THREAD_THRESHOLD", "65536"),
+    help="bodies longer than this are rendered in a thread. 0 to disable. "
+    "Default: 65536. Environment variable: `MARKDOWN_THREAD_THRESHOLD`",
+)
+parser.add_argument(
+    "--max-message-size",
+    type=int,
+    default=os.environ.get("MAX_MESSAGE_SIZE", "60000"),
+    help="maximum size of the content of a message, in bytes. Matrix events are "
+    "limited to 65536 bytes, including metadata. "
+    "Default: 60000. Environment variable: `MAX_MESSAGE_SIZE`",
+)
+parser.add_argument(
+    "--oversize",
+    choices=["split", "truncate"],
+    default=os.environ.get("OVERSIZE", "split"),
+    help="what to do with messages larger than `--max-message-size`: split them "
+    "in several messages, or truncate them. "
+    "Default: `split`. Environment variable: `OVERSIZE`",
+)
+parser.add_argument(
+    "--oversize-policy",
+    default=os.environ.get("OVERSIZE_POLICY", ""),
+    help="`--oversize` for some formatters, eg. `grafana=truncate,github=split`. "
+    "Default: `''`. Environment variable: `OVERSIZE_POLICY`",
+)
+parser.add_argument(
+    "--coalesce-window",
+    type=float,
+    default=os.environ.get("COALESCE_WINDOW", "0"),
+    help="merge messages sent to a room within this many seconds in a digest, "
+    "up to 3600. 0 to disable. Default: 0. Environment variable: `COALESCE_WINDOW`",
+)
+parser.add_argument(
+    "--coalesce-policy",
+    default=os.environ.get("COALESCE_POLICY", ""),
+    help="`--coalesce-window` for some formatters, eg. `grafana=60,grafana_9x=60`. "
+    "Default: `''`. Environment variable: `COALESCE_POLICY`",
+)
+parser.add_argument(
+    "--coalesce-max",
+    type=int,
+    default=os.environ.get("COALESCE_MAX", "100"),
+    help="send a digest as soon as it has this many messages. "
+    "Default: 100. Environment variable: `COALESCE_MAX`",
+)
+parser.add_argument(
+    "--edit-alerts",
+    action="store_true",
+    default="EDIT_ALERTS" in os.environ,
+    help="send updates of a Grafana alert as edits of its first message. "
+    "Environment variable: `EDIT_ALERTS`",
+)
+parser.add_argument(
+    "--edits-size",
+    type=int,
+    default=os.environ.get("EDITS_SIZE", "10000"),
+    help="number of alerts of which the first message is kept for edits. "
+    "Default: 10000. Environment variable: `EDITS_SIZE`",
+)
+parser.add_argument(
+    "--edits-ttl",
+    type=float,
+    default=os.environ.get("EDITS_TTL", "86400"),
+    help="seconds during which an alert can be edited. "
+    "Default: 86400. Environment variable: `EDITS_TTL`",
+)
+parser.add_argument(
+    "--edits-file",
+    default=os.environ.get("EDITS_FILE", ""),
+    help="JSON file where alerts for edits are kept across restarts. "
+    "Default: `''`. Environment variable: `EDITS_FILE`",
+)
+parser.add_argument(
+    "--dedup-ttl",
+    type=float,
+    default=os.environ.get("DEDUP_TTL", "3600"),
+    help="seconds during which redelivered webhooks get the original result. "
+    "0 to disable. Default: 3600. Environment variable: `DEDUP_TTL`",
+)
+parser.add_argument(
+    "--dedup-size",
+    type=int,
+    default=os.environ.get("DEDUP_SIZE", "10000"),
+    help="number of results kept for redelivered webhooks. "
+    "Default: 10000. Environment variable: `DEDUP_SIZE`",
+)
+parser.add_argument(
+    "--dedup-content",
+    action="store_true",
+    default="DEDUP_CONTENT" in os.environ,
+    help="also deduplicate webhooks without delivery id, by content. "
+    "Environment variable: `DEDUP_CONTENT`",
+)
+parser.add_argument(
+    "--rate-limit",
+    type=float,
+    default=os.environ.get("RATE_LIMIT", "0"),
+    help="maximum messages per second for the bot account. 0 to only follow the "
+    "homeserver limits. Default: 0. Environment variable: `RATE_LIMIT`",
+)
+parser.add_argument(
+    "--room-rate-limit",
+    type=float,
+    default=os.environ.get("ROOM_RATE_LIMIT", "0"),
+    help="maximum messages per second in a room. 0 for unlimited. "
+    "Default: 0. Environment variable: `ROOM_RATE_LIMIT`",
+)
+parser.add_argument(
+    "--rate-limit-burst",
+    type=int,
+    default=os.environ.get("RATE_LIMIT_BURST", "10"),
+    help="messages which can be sent at once before being paced by rate limits. "
+    "Default: 10. Environment variable: `RATE_LIMIT_BURST`",
+)
+parser.add_argument(
+    "--retry-attempts",
+    type=int,
+    default=os.environ.get("RETRY_ATTEMPTS", "10"),
+    help="maximum attempts for a request to the homeserver. "
+    "Default: 10. Environment variable: `RETRY_ATTEMPTS`",
+)
+parser.add_argument(
+    "--retry-base-delay",
+    type=float,
+    default=os.environ.get("RETRY_BASE_DELAY", "0.1"),
+    help="seconds before the first retry, then doubled on each attempt, with jitter. "
+    "Default: 0.1. Environment variable: `RETRY_BASE_DELAY`",
+)
+parser.add_argument(
+    "--retry-max-delay",
+    type=float,
+    default=os.environ.get("RETRY_MAX_DELAY", "10"),
+    help="maximum seconds between two attempts. "
+    "Default: 10. Environment variable: `RETRY_MAX_DELAY`",
+)
+parser.add_argument(
+    "--retry-deadline",
+    type=float,
+    default=os.environ.get("RETRY_DEADLINE", "30"),
+    help="maximum seconds spent retrying a request to the homeserver. "
+    "Default: 30. Environment variable: `RETRY_DEADLINE`",
+)
+parser.add_argument(
+    "--breaker-threshold",
+    type=int,
+    default=os.environ.get("BREAKER_THRESHOLD", "5"),
+    help="consecutive homeserver failures before failing fast. "
+    "Default: 5. Environment variable: `BREAKER_THRESHOLD`",
+)
+parser.add_argument(
+    "--breaker-timeout",
+    type=float,
+    default=os.environ.get("BREAKER_TIMEOUT", "30"),
+    help="seconds to fail fast before probing the homeserver again. "
+    "Default: 30. Environment variable: `BREAKER_TIMEOUT`",
+)
+parser.add_argument(
+    "--async-delivery",
+    action="store_true",
+    default="ASYNC_DELIVERY" in os.environ,
+    help="answer 202 as soon as a message is queued, and deliver it in the background. "
+    "Environment variable: `ASYNC_DELIVERY`",
+)
+parser.add_argument(
+    "--outbox",
+    default=os.environ.get("OUTBOX", ""),
+    help="SQLite file where queued messages are kept until delivered. "
+    "Implies `--async-delivery`. Default: `''`. Environment variable: `OUTBOX`",
+)
+parser.add_argument(
+    "--delivery-workers",
+    type=int,
+    default=os.environ.get("DELIVERY_WORKERS", "8"),
+    help="number of rooms delivered in parallel with `--async-delivery`. "
+    "Default: 8. Environment variable: `DELIVERY_WORKERS`",
+)
+parser.add_argument(
+    "--delivery-attempts",
+    type=int,
+    default=os.environ.get("DELIVERY_ATTEMPTS", "20"),
+    help="maximum attempts to deliver a queued message when the homeserver fails, "
+    "or 0 to try forever. Default: 20. Environment variable: `DELIVERY_ATTEMPTS`",
+)
+parser.add_argument(
+    "--drain-timeout",
+    type=float,
+    default=os.environ.get("DRAIN_TIMEOUT", "10"),
+    help="seconds to wait for queued messages on shutdown. "
+    "Default: 10. Environment variable: `DRAIN_TIMEOUT`",
+)
 
 
 args = parser.parse_args()
 
+# argparse doesn't check defaults against choices, eg. when they come from the environment
+for action in parser._actions:
+    if action.choices is None:
+        continue
+    value = getattr(args, action.dest)
+    if value not in action.choices:
+        parser.error(f"invalid {'/'.join(action.option_strings)}: {value}")
+
 SERVER_ADDRESS = (args.host, args.port)
 SERVER_PATH = args.server_path
+WORKERS = args.workers
+LOOP = args.loop
+ACCESS_LOG = not args.no_access_log
 MATRIX_URL = args.matrix_url
 MATRIX_ID = args.matrix_id
 MATRIX_PW = args.matrix_pw
@@ -92,3 +440,85 @@ MATRIX_TOKEN = args.matrix_token
 API_KEY = args.api_key
 VERBOSE = args.verbose
 PROXY = args.proxy
+try:
+    ACCOUNTS = json.loads(Path(args.accounts).read_text()) if args.accounts else []
+except (OSError, ValueError) as e:
+    parser.error(f"can't read --accounts: {e}")
+if not isinstance(ACCOUNTS, list) or not all(
+    isinstance(account, dict)
+    and account.get("user_id")
+    and (account.get("password") or account.get("token"))
+    for account in ACCOUNTS
+):
+    parser.error("--accounts must list objects with a user_id and a password or token")
+HTTP_POOL_SIZE = args.http_pool_size
+HTTP_KEEPALIVE = args.http_keepalive
+HTTP_DNS_TTL = args.http_dns_ttl
+HTTP_TIMEOUT = args.http_timeout
+HTTP_CONNECT_TIMEOUT = args.http_connect_timeout
+HTTP_READ_TIMEOUT = args.http_read_timeout
+HTTP_WARMUP = args.http_warmup
+JOINED_ROOMS_TTL = args.joined_rooms_ttl
+PRIME_JOINED_ROOMS = args.prime_joined_rooms
+ALIAS_TTL = args.alias_ttl
+ALIAS_NEGATIVE_TTL = args.alias_negative_ttl
+FORBIDDEN_TTL = args.forbidden_ttl
+FORBIDDEN_MAX_TTL = args.forbidden_max_ttl
+MAX_BODY_SIZE = args.max_body_size
+FANOUT_CONCURRENCY = args.fanout_concurrency
+MARKDOWN_CACHE_SIZE = args.markdown_cache_size
+MARKDOWN_THREAD_THRESHOLD = args.markdown_thread_threshold
+MAX_MESSAGE_SIZE = args.max_message_size
+OVERSIZE = args.oversize
+OVERSIZE_POLICY = dict(
+    policy.strip().partition("=")[::2]
+    for policy in args.oversize_policy.split(",")
+    if policy.strip()
+)
+if not set(OVERSIZE_POLICY.values()) <= {"split", "truncate"}:
+    parser.error(f"invalid --oversize-policy: {args.oversize_policy}")
+MAX_COALESCE_WINDOW = 3600  # seconds a webhook can ask messages to be held
+COALESCE_WINDOW = args.coalesce_window
+if not math.isfinite(COALESCE_WINDOW) or COALESCE_WINDOW > MAX_COALESCE_WINDOW:
+    parser.error(f"invalid --coalesce-window: {args.coalesce_window}")
+try:
+    COALESCE_POLICY = {
+        formatter.strip(): float(seconds)
+        for formatter, _, seconds in (
+            policy.partition("=") for policy in args.coalesce_policy.split(",")
+        )
+        if formatter.strip()
+    }
+except ValueError:
+    parser.error(f"invalid --coalesce-policy: {args.coalesce_policy}")
+if not all(
+    math.isfinite(seconds) and seconds <= MAX_COALESCE_WINDOW
+    for seconds in COALESCE_POLICY.values()
+):
+    parser.error(f"invalid --coalesce-policy: {args.coalesce_policy}")
+COALESCE_MAX = args.coalesce_max
+EDIT_ALERTS = args.edit_alerts
+EDITS_SIZE = args.edits_size
+EDITS_TTL = args.edits_ttl
+EDITS_FILE = args.edits_file
+DEDUP_TTL = args.dedup_ttl
+DEDUP_SIZE = args.dedup_size
+DEDUP_CONTENT = args.dedup_content
+RATE_LIMIT = args.rate_limit
+ROOM_RATE_LIMIT = args.room_rate_limit
+RATE_LIMIT_BURST = args.rate_limit_burst
+RETRY_ATTEMPTS = args.retry_attempts
+RETRY_BASE_DELAY = args.retry_base_delay
+RETRY_MAX_DELAY = args.retry_max_delay
+RETRY_DEADLINE = args.retry_deadline
+BREAKER_THRESHOLD = args.breaker_threshold
+BREAKER_TIMEOUT = args.breaker_timeout
+OUTBOX = args.outbox
+ASYNC_DELIVERY = args.async_delivery or bool(OUTBOX)
+DELIVERY_WORKERS = args.delivery_workers
+DELIVERY_ATTEMPTS = args.delivery_attempts
+DRAIN_TIMEOUT = args.drain_timeout
+if WORKERS > 1 and OUTBOX:
+    parser.error("--outbox can only be used by a single worker")
+if WORKERS > 1 and EDIT_ALERTS and EDITS_FILE:
+    parser.error("--edits-file can only be used by a single worker")
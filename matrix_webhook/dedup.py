@@ -0,0 +1,95 @@
+"""Matrix Webhook deduplication of redelivered webhooks.
+
+Github, Gitlab and others send a webhook again when they don't get an answer in time.
+Successful results are kept for conf.DEDUP_TTL seconds, by delivery id, and answered
+again to redeliveries without touching the homeserver. A redelivery which comes while
+the original is still being handled waits for its result.
+"""
+
+import asyncio
+import logging
+import time
+from collections import OrderedDict
+from http import HTTPStatus
+
+from aiohttp import web
+
+from . import conf, metrics
+
+LOGGER = logging.getLogger("matrix_webhook.dedup")
+HEADERS = ["X-GitHub-Delivery", "X-Gitlab-Event-UUID"]
+CACHE = OrderedDict()  # key -> (status, body, expiration)
+PENDING = {}  # key -> future of the (status, body) of the original delivery
+DUPLICATES = metrics.Counter(
+    "matrix_webhook_duplicates_total",
+    "Redelivered webhooks answered from the deduplication cache.",
+)
+
+
+def key(request, digest):
+    """Identify a delivery by its id, or by its content with conf.DEDUP_CONTENT.
+
+    The path and query are included, as the same webhook can be sent to many URLs,
+    and so is the HMAC of the body, st. only the same body can get the same result.
+    """
+    if not conf.DEDUP_TTL:
+        return None
+    for header in HEADERS:
+        if header in request.headers:
+            return (request.headers[header], str(request.rel_url), digest)
+    if conf.DEDUP_CONTENT:
+        return (None, str(request.rel_url), digest)
+    return None
+
+
+def get(key):
+    """Get the result of a previous delivery, if still known."""
+    if key not in CACHE:
+        return None
+    status, body, expires = CACHE[key]
+    if expires < time.monotonic():
+        del CACHE[key]
+        return None
+    return status, body
+
+
+def put(key, status, body):
+    """Keep a successful result."""
+    CACHE[key] = (status, body, time.monotonic() + conf.DEDUP_TTL)
+    CACHE.move_to_end(key)
+    while len(CACHE) > conf.DEDUP_SIZE:
+        CACHE.popitem(last=False)
+
+
+def replay(key, result):
+    """Answer a redelivery with the result of the original one."""
+    msg = f"Duplicate delivery {key[0] or 'of the same content'} on {key[1]}"
+    LOGGER.info(msg)
+    DUPLICATES.inc()
+    status, body = result
+    return web.Response(body=body, status=status, content_type="application/json")
+
+
+async def once(key, handle):
+    """Handle a delivery, unless it was already done."""
+    result = get(key)
+    if result is not None:
+        return replay(key, result)
+    if key in PENDING:
+        result = await asyncio.shield(PENDING[key])
+        if result is not None:
+            return replay(key, result)
+        # the original delivery crashed, so try again
+        return await once(key, handle)
+
+    future = PENDING[key] = asyncio.get_event_loop().create_future()
+    result = None
+    try:
+        resp = await handle()
+        result = (resp.status, resp.body)
+        if HTTPStatus.OK <= resp.status < HTTPStatus.MULTIPLE_CHOICES:
+            put(key, *result)
+        return resp
+    finally:
+        del PENDING[key]
+        future.set_result(result)
@@ -0,0 +1,163 @@
+"""Matrix Webhook asynchronous delivery.
+
+Messages are kept in one FIFO queue per room. A room with pending messages is put
+in the READY queue, where a pool of workers take it, deliver its oldest message,
+and put it back if it still has pending messages. As a room is handled by at most
+one worker at a time, ordering holds within a room, while rooms are delivered in
+parallel.
+
+When the homeserver fails, the message is kept at the head of its queue, and the
+room is put back in the READY queue later, following the retry policy, up to
+conf.DELIVERY_ATTEMPTS times. Other errors won't get better by trying again, so those
+messages are dropped, or moved to the dead letters of the outbox.
+"""
+
+import asyncio
+import logging
+from collections import Counter, defaultdict, deque
+from http import HTTPStatus
+from uuid import uuid4
+
+from aiohttp import ClientError
+
+from . import conf, metrics, outbox, retry, utils
+
+LOGGER = logging.getLogger("matrix_webhook.delivery")
+QUEUES = defaultdict(deque)  # room_id -> pending (content, outbox id, transaction id)
+READY = None  # asyncio.Queue of room_ids, created in start()
+FAILURES = Counter()  # room_id -> consecutive failed deliveries
+WORKERS = []
+DROPPED = metrics.Counter(
+    "matrix_webhook_dropped_messages_total",
+    "Queued messages given up, by reason: rejected, or too many attempts.",
+)
+metrics.Gauge(
+    "matrix_webhook_queued_messages",
+    "Messages waiting for asynchronous delivery.",
+    function=lambda: sum(len(queue) for queue in QUEUES.values()),
+)
+
+
+def enqueue(room_id, content, outbox_id=None):
+    """Queue a message for a room."""
+    msg = f"Queue message for {room_id=}"
+    LOGGER.debug(msg)
+    queue = QUEUES[room_id]
+    # the same transaction id is used for all the attempts
+    queue.append((content, outbox_id, str(uuid4())))
+    if len(queue) == 1:
+        # otherwise, this room is already READY, waiting for a retry,
+        # or handled by a worker
+        READY.put_nowait(room_id)
+
+
+async def submit(room_id, content):
+    """Store a message in the outbox if there is one, and queue it."""
+    outbox_id = await outbox.add(room_id, content) if conf.OUTBOX else None
+    enqueue(room_id, content, outbox_id)
+
+
+def transient(resp):
+    """Check if a failed delivery can succeed later: rate limits and homeserver failures.
+
+    Errors with a Matrix errcode are answers of the homeserver, which won't change.
+    """
+    return resp.status in {
+        HTTPStatus.TOO_MANY_REQUESTS,
+        HTTPStatus.SERVICE_UNAVAILABLE,
+        HTTPStatus.GATEWAY_TIMEOUT,
+    } or (
+        resp.status >= HTTPStatus.INTERNAL_SERVER_ERROR and resp.get("errcode") is None
+    )
+
+
+def ready_again(room_id):
+    """Make a room READY again after a failure."""
+    READY.put_nowait(room_id)
+    # this room was not done when it failed
+    READY.task_done()
+
+
+async def worker():
+    """Deliver messages from READY rooms, forever."""
+    loop = asyncio.get_event_loop()
+    while True:
+        room_id = await READY.get()
+        queue = QUEUES[room_id]
+        content, outbox_id, tx_id = queue[0]
+        try:
+            resp = await utils.deliver(room_id, content, tx_id)
+        except ClientError as e:
+            error, retriable = repr(e), True
+            msg = f"Delivery failed in {room_id=}: {error}"
+            LOGGER.error(msg)
+        except Exception as e:
+            error, retriable = repr(e), False
+            msg = f"Delivery crashed in {room_id=}"
+            LOGGER.exception(msg)
+        else:
+            error, retriable = None, False
+            if resp.status >= HTTPStatus.MULTIPLE_CHOICES:
+                error, retriable = resp.text, transient(resp)
+                msg = f"Delivery failed in {room_id=}: {error}"
+                LOGGER.error(msg)
+
+        if error is not None:
+            attempts = FAILURES[room_id] + 1
+            if retriable and attempts != conf.DELIVERY_ATTEMPTS:
+                FAILURES[room_id] = attempts
+                delay = max(retry.backoff(attempts - 1), retry.BREAKER.retry_after())
+                msg = f"Retrying {room_id=} in {delay:.3f}s"
+                LOGGER.warning(msg)
+                loop.call_later(delay, ready_again, room_id)
+                continue
+            reason = "attempts" if retriable else "rejected"
+            DROPPED.inc(reason=reason)
+            msg = f"Giving up a message for {room_id=} after {attempts} attempts"
+            LOGGER.error(msg)
+            if outbox_id is not None:
+                outbox.dead(outbox_id, error)
+                outbox_id = None
+
+        # delivered, or rejected for good
+        FAILURES.pop(room_id, None)
+        queue.popleft()
+        if outbox_id is not None:
+            outbox.ack(outbox_id)
+        if queue:
+            READY.put_nowait(room_id)
+        else:
+            del QUEUES[room_id]
+        READY.task_done()
+
+
+async def start():
+    """Launch the delivery workers, and replay the outbox."""
+    global READY
+    READY = asyncio.Queue()
+    msg = f"Starting {conf.DELIVERY_WORKERS} delivery workers"
+    LOGGER.info(msg)
+    WORKERS.extend(
+        asyncio.ensure_future(worker()) for _ in range(conf.DELIVERY_WORKERS)
+    )
+    if conf.OUTBOX:
+        for outbox_id, room_id, content in await outbox.open_outbox():
+            enqueue(room_id, content, outbox_id)
+
+
+async def stop():
+    """Wait for pending messages, up to conf.DRAIN_TIMEOUT, and stop the workers."""
+    if READY is None:
+        return
+    try:
+        await asyncio.wait_for(READY.join(), conf.DRAIN_TIMEOUT)
+    except asyncio.TimeoutError:
+        pending = sum(len(queue) for queue in QUEUES.values())
+        where = "kept in the outbox" if conf.OUTBOX else "dropped"
+        msg = f"{pending} undelivered messages {where}"
+        LOGGER.error(msg)
+    for task in WORKERS:
+        task.cancel()
+    await asyncio.gather(*WORKERS, return_exceptions=True)
+    WORKERS.clear()
+    await outbox.close_outbox()
@@ -0,0 +1,132 @@
+"""Matrix Webhook alert edits.
+
+Alerts are identified by the fingerprints of the grafana_9x `alerts` payload. The first
+message for an alert is sent as usual, and its event_id kept in a LRU index, with a
+TTL. Later updates of the same alert, eg. when it is resolved, are sent as `m.replace`
+edits of this first message, instead of new messages. Only the account which sent the
+first message can edit it.
+
+The index can be saved to a JSON file, so that edits survive restarts.
+"""
+
+import asyncio
+import json
+import logging
+import time
+from collections import OrderedDict
+from pathlib import Path
+
+from . import conf, metrics, split
+
+LOGGER = logging.getLogger("matrix_webhook.edits")
+# where the fingerprint of an alert is kept in a content, until it is sent
+FINGERPRINT = "fingerprint"
+# (room_id, fingerprint) -> (event_id, expiration timestamp, sender)
+INDEX = OrderedDict()
+SAVE_DELAY = 1  # seconds, to save many changes at once
+SAVER = None
+EDITS = metrics.Counter(
+    "matrix_webhook_edits_total",
+    "Alert updates sent as edits of their first message.",
+)
+metrics.Gauge(
+    "matrix_webhook_edits_index_size",
+    "Alerts of which the first message is known.",
+    function=lambda: len(INDEX),
+)
+
+
+def fingerprint(data):
+    """Identify the alerts of a grafana_9x payload, if any."""
+    alerts = data.get("alerts")
+    if not isinstance(alerts, list):
+        return None
+    fingerprints = sorted(
+        alert["fingerprint"]
+        for alert in alerts
+        if isinstance(alert, dict) and alert.get("fingerprint")
+    )
+    return ",".join(fingerprints) or None
+
+
+def get(room_id, fingerprint, sender):
+    """Get the event_id of the first message of an alert in a room, if still known."""
+    key = (room_id, fingerprint)
+    if key not in INDEX:
+        return None
+    event_id, expires, sent_by = INDEX[key]
+    if expires < time.time():
+        del INDEX[key]
+        return None
+    return event_id if sent_by == sender else None
+
+
+def remember(room_id, fingerprint, event_id, sender):
+    """Keep the first message of an alert for conf.EDITS_TTL seconds."""
+    key = (room_id, fingerprint)
+    INDEX[key] = (event_id, time.time() + conf.EDITS_TTL, sender)
+    INDEX.move_to_end(key)
+    while len(INDEX) > conf.EDITS_SIZE:
+        INDEX.popitem(last=False)
+    schedule_save()
+
+
+def replace(content, event_id):
+    """Make an edit of event_id from a content, or None if it would be too large."""
+    edit = {
+        "msgtype": content["msgtype"],
+        "body": f"* {content['body']}",
+        "format": content["format"],
+        "formatted_body": f"* {content['formatted_body']}",
+        "m.new_content": content,
+        "m.relates_to": {"rel_type": "m.replace", "event_id": event_id},
+    }
+    return edit if split.fits(edit) else None
+
+
+def load():
+    """Read the index from conf.EDITS_FILE.
+
+    A file which can't be read, eg. corrupt or half written, is ignored: alerts then
+    start new messages.
+    """
+    path = Path(conf.EDITS_FILE)
+    if not path.exists():
+        return
+    now = time.time()
+    loaded = {}
+    try:
+        for room_id, fingerprint, event_id, expires, sender in json.loads(
+            path.read_text(),
+        ):
+            if expires > now:
+                loaded[room_id, fingerprint] = (event_id, expires, sender)
+    except (OSError, TypeError, ValueError) as e:
+        msg = f"Can't load alerts from {conf.EDITS_FILE}, starting without them: {e!r}"
+        LOGGER.warning(msg)
+        return
+    INDEX.update(loaded)
+    msg = f"Loaded {len(INDEX)} alerts from {conf.EDITS_FILE}"
+    LOGGER.info(msg)
+
+
+def save():
+    """Write the index to conf.EDITS_FILE."""
+    global SAVER
+    if SAVER is not None:
+        SAVER.cancel()
+        SAVER = None
+    if not conf.EDITS_FILE:
+        return
+    path = Path(conf.EDITS_FILE)
+    entries = [[*key, *value] for key, value in INDEX.items()]
+    tmp = path.with_suffix(".tmp")
+    tmp.write_text(json.dumps(entries))
+    tmp.replace(path)
+
+
+def schedule_save():
+    """Save the index soon, if it is persisted."""
+    global SAVER
+    if conf.EDITS_FILE and SAVER is None:
+        SAVER = asyncio.get_event_loop().call_later(SAVE_DELAY, save)
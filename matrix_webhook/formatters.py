@@ -1,32 +1,38 @@
 """Formatters for matrix webhook."""
 
+import logging
 import re
+from importlib.metadata import entry_points
+
+ENTRY_POINTS = "matrix_webhook.formatters"
+GCHAT_LINK = re.compile("<(.*?)\\|(.*?)>", flags=re.MULTILINE)
+LOGGER = logging.getLogger("matrix_webhook.formatters")
 
 
 def grafana(data, headers):
     """Pretty-print a Grafana (version 8 and older) notification."""
-    text = ""
     if "ruleName" not in data and "alerts" in data:
         return grafana_9x(data, headers)
+    text = []
     if "title" in data:
-        text = "#### " + data["title"] + "\n"
+        text += ["#### ", data["title"], "\n"]
     if "message" in data:
-        text = text + data["message"] + "\n\n"
+        text += [data["message"], "\n\n"]
     if "evalMatches" in data:
         for match in data["evalMatches"]:
-            text = text + "* " + match["metric"] + ": " + str(match["value"]) + "\n"
-    data["body"] = text
+            text += ["* ", match["metric"], ": ", str(match["value"]), "\n"]
+    data["body"] = "".join(text)
     return data
 
 
 def grafana_9x(data, headers):
     """Pretty-print a Grafana newer than v9.x notification."""
-    text = ""
+    text = []
     if "title" in data:
-        text = "#### " + data["title"] + "\n"
+        text += ["#### ", data["title"], "\n"]
     if "message" in data:
-        text = text + data["message"].replace("\n", "\n\n") + "\n\n"
-    data["body"] = text
+        text += [data["message"].replace("\n", "\n\n"), "\n\n"]
+    data["body"] = "".join(text)
     return data
 
 
@@ -38,9 +44,10 @@ def github(data, headers):
             data[k] for k in ["pusher", "ref", "after", "before", "compare"]
         )
         pusher = f"[@{pusher['name']}](https://github.com/{pusher['name']})"
-        data["body"] = f"{pusher} pushed on {ref}: [{b} → {a}]({c}):\n\n"
+        body = [f"{pusher} pushed on {ref}: [{b} → {a}]({c}):\n\n"]
         for commit in data["commits"]:
-            data["body"] += f"- [{commit['message']}]({commit['url']})\n"
+            body.append(f"- [{commit['message']}]({commit['url']})\n")
+        data["body"] = "".join(body)
     else:
         data["body"] = "notification from github"
     data["digest"] = headers["X-Hub-Signature-256"].replace("sha256=", "")
@@ -49,12 +56,7 @@ def github(data, headers):
 
 def gitlab_gchat(data, headers):
     """Pretty-print a gitlab notification preformatted for Google Chat."""
-    data["body"] = re.sub(
-        "<(.*?)\\|(.*?)>",
-        "[\\2](\\1)",
-        data["body"],
-        flags=re.MULTILINE,
-    )
+    data["body"] = GCHAT_LINK.sub("[\\2](\\1)", data["body"])
     return data
 
 
@@ -62,13 +64,12 @@ def gitlab_teams(data, headers):
     """Pretty-print a gitlab notification preformatted for Microsoft Teams."""
     body = []
     for section in data["sections"]:
-        if "text" in section.keys():
+        if "text" in section:
             text = section["text"].split("\n\n")
             text = ["* " + t for t in text]
             body.append("\n" + "  \n".join(text))
         elif all(
-            k in section.keys()
-            for k in ("activityTitle", "activitySubtitle", "activityText")
+            k in section for k in ("activityTitle", "activitySubtitle", "activityText")
         ):
             text = section["activityTitle"] + " " + section["activitySubtitle"] + " → "
             text += section["activityText"]
@@ -111,3 +112,40 @@ def grn(data, headers):
     )
 
     return data
+
+
+# name -> formatter, see load_plugins() for third-party ones
+FORMATTERS = {
+    formatter.__name__: formatter
+    for formatter in [
+        github,
+        gitlab_gchat,
+        gitlab_teams,
+        gitlab_webhook,
+        grafana,
+        grafana_9x,
+        grn,
+    ]
+}
+
+
+def load_plugins():
+    """Register formatters from the `matrix_webhook.formatters` entry points."""
+    eps = entry_points()
+    if hasattr(eps, "select"):
+        eps = eps.select(group=ENTRY_POINTS)
+    else:  # python < 3.10
+        eps = eps.get(ENTRY_POINTS, [])
+    for ep in eps:
+        if ep.name in FORMATTERS:
+            msg = f"Formatter {ep.name} from {ep.value} is already defined, skipping"
+            LOGGER.warning(msg)
+            continue
+        try:
+            FORMATTERS[ep.name] = ep.load()
+        except (ImportError, AttributeError) as e:
+            msg = f"Can't load formatter {ep.name} from {ep.value}: {e!r}"
+            LOGGER.error(msg)
+        else:
+            msg = f"Loaded formatter {ep.name} from {ep.value}"
+            LOGGER.info(msg)
@@ -1,15 +1,32 @@
 """Matrix Webhook main request handler."""
 
+import asyncio
 import json
 import logging
+import time
+from collections import defaultdict
 from hmac import HMAC
 from http import HTTPStatus
 
-from markdown import markdown
+from aiohttp import web
 
-from . import conf, formatters, utils
+from . import (
+    coalesce,
+    codec,
+    conf,
+    dedup,
+    delivery,
+    edits,
+    formatters,
+    metrics,
+    retry,
+    split,
+    utils,
+)
 
 LOGGER = logging.getLogger("matrix_webhook.handler")
+SIGNATURE_HEADER = "X-Hub-Signature-256"
+KEY_HEADERS = {"gitlab_webhook": "X-Gitlab-Token"}  # headers formatters take keys from
 
 
 async def matrix_webhook(request):
@@ -22,15 +39,150 @@ async def matrix_webhook(request):
 
     # healthcheck
     if request.rel_url.path == "/health":
-        return utils.create_json_response(HTTPStatus.OK, "OK")
+        return utils.create_json_response(
+            HTTPStatus.OK,
+            "OK",
+            breaker=retry.BREAKER.state,
+        )
+
+    if request.rel_url.path == "/metrics":
+        return web.Response(
+            body=metrics.expose().encode(),
+            headers={"Content-Type": metrics.CONTENT_TYPE},
+        )
+
+    if request.rel_url.path == "/admin/forbidden-rooms":
+        return admin_forbidden_rooms(request)
+
+    metrics.IN_FLIGHT.inc()
+    try:
+        resp = await handle_webhook(request)
+    finally:
+        metrics.IN_FLIGHT.dec()
+    metrics.REQUESTS.inc(formatter=formatter_label(request), status=resp.status)
+    return resp
+
+
+def admin_forbidden_rooms(request):
+    """List the rooms where the bot can't post with a GET, or forget them with a DELETE.
+
+    With a DELETE, only the rooms given as `room_id` query parameters are forgotten,
+    or all of them if there is none.
+    """
+    if request.rel_url.query.get("key") != conf.API_KEY:
+        return utils.create_json_response(HTTPStatus.UNAUTHORIZED, "Invalid API key")
+    if request.method == "GET":
+        return utils.create_json_response(
+            HTTPStatus.OK,
+            "OK",
+            rooms=utils.forbidden_rooms(),
+        )
+    if request.method == "DELETE":
+        room_ids = request.rel_url.query.getall("room_id", None)
+        forgotten = utils.forget_forbidden(room_ids)
+        return utils.create_json_response(HTTPStatus.OK, "OK", forgotten=forgotten)
+    return utils.create_json_response(
+        HTTPStatus.METHOD_NOT_ALLOWED,
+        "Method not allowed",
+    )
+
+
+def formatter_label(request):
+    """Get the formatter of a request, without unknown names to keep few labels."""
+    name = request.rel_url.query.get("formatter", "")
+    if name and name not in formatters.FORMATTERS:
+        return "unknown"
+    return name
+
+
+async def handle_webhook(request):
+    """Check the content of a webhook, format it, and forward it to the matrix room."""
+    # reject wrong keys before reading anything
+    if wrong_key(request):
+        return utils.create_json_response(HTTPStatus.UNAUTHORIZED, "Invalid API key")
 
-    data_b = await request.read()
+    body = await read_body(request)
+    if isinstance(body, web.Response):
+        return body
+    data_b, digest = body
 
+    # reject wrong signatures before parsing anything
+    signature = request.headers.get(SIGNATURE_HEADER, "").replace("sha256=", "")
+    if signature and "key" not in request.rel_url.query and signature != digest:
+        return utils.create_json_response(
+            HTTPStatus.UNAUTHORIZED,
+            "Invalid SHA-256 HMAC digest",
+        )
+
+    key = dedup.key(request, digest)
+    if key is not None:
+        return await dedup.once(key, lambda: process(request, data_b, digest))
+    return await process(request, data_b, digest)
+
+
+def wrong_key(request):
+    """Check the keys given in the query string, or in the header of the formatter."""
+    keys = request.rel_url.query.getall("key", [])
+    header = KEY_HEADERS.get(request.rel_url.query.get("formatter"))
+    if header in request.headers:
+        keys.append(request.headers[header])
+    return any(key != conf.API_KEY for key in keys)
+
+
+async def process(request, data_b, digest):
+    """Parse a webhook, format it, and forward it to the matrix room."""
     try:
-        data = json.loads(data_b.decode())
+        with metrics.STAGE_SECONDS.time(stage="parse"):
+            data = parse(request, data_b)
     except json.decoder.JSONDecodeError:
         return utils.create_json_response(HTTPStatus.BAD_REQUEST, "Invalid JSON")
 
+    if isinstance(data, list):
+        return await handle_batch(request, data, digest)
+
+    prepared = await prepare(request, data, digest)
+    if isinstance(prepared, web.Response):
+        return prepared
+    return await send(*prepared)
+
+
+async def read_body(request):
+    """Read the body, up to conf.MAX_BODY_SIZE, and compute its HMAC on the way.
+
+    Return either an error response, or the body and its SHA-256 HMAC hex digest.
+    """
+    too_large = utils.create_json_response(
+        HTTPStatus.REQUEST_ENTITY_TOO_LARGE,
+        "Payload too large",
+    )
+    if request.content_length and request.content_length > conf.MAX_BODY_SIZE:
+        return too_large
+
+    hmac = HMAC(conf.API_KEY.encode(), digestmod="sha256")
+    chunks = []
+    size = 0
+    async for chunk in request.content.iter_any():
+        size += len(chunk)
+        if size > conf.MAX_BODY_SIZE:
+            return too_large
+        hmac.update(chunk)
+        chunks.append(chunk)
+    return b"".join(chunks), hmac.hexdigest()
+
+
+def parse(request, data_b):
+    """Parse a JSON body, or a batch of messages as newline delimited JSON."""
+    if request.content_type == "application/x-ndjson":
+        return [codec.loads(line) for line in data_b.splitlines() if line.strip()]
+    return codec.loads(data_b)
+
+
+async def prepare(request, data, digest):
+    """Check and format a message.
+
+    Return either a response, or the room_ids and the contents of the message,
+    which might be split in several ones.
+    """
     # legacy naming
     if "text" in data and "body" not in data:
         data["body"] = data["text"]
@@ -40,26 +192,29 @@ async def matrix_webhook(request):
         data["key"] = request.rel_url.query["key"]
 
     if "formatter" in request.rel_url.query:
-        try:
-            data = getattr(formatters, request.rel_url.query["formatter"])(
-                data,
-                request.headers,
-            )
-        except AttributeError:
+        name = request.rel_url.query["formatter"]
+        formatter = formatters.FORMATTERS.get(name)
+        if formatter is None:
             return utils.create_json_response(
                 HTTPStatus.BAD_REQUEST,
                 "Unknown formatter",
             )
+        start = time.perf_counter()
+        data = formatter(data, request.headers)
+        duration = time.perf_counter() - start
+        metrics.STAGE_SECONDS.observe(duration, stage="formatter")
+        metrics.FORMATTER_SECONDS.observe(duration, formatter=name)
 
     if "room_id" in request.rel_url.query and "room_id" not in data:
-        data["room_id"] = request.rel_url.query["room_id"]
+        data["room_id"] = request.rel_url.query.getall("room_id")
     if "room_id" not in data:
         data["room_id"] = request.path.lstrip("/")
+    data["room_id"] = room_list(data["room_id"])
 
     # If we get a good SHA-256 HMAC digest,
     # we can consider that the sender has the right API key
     if "digest" in data:
-        if data["digest"] == HMAC(conf.API_KEY.encode(), data_b, "sha256").hexdigest():
+        if data["digest"] == digest:
             data["key"] = conf.API_KEY
         else:  # but if there is a wrong digest, an informative error should be provided
             return utils.create_json_response(
@@ -80,20 +235,147 @@ async def matrix_webhook(request):
     if data["key"] != conf.API_KEY:
         return utils.create_json_response(HTTPStatus.UNAUTHORIZED, "Invalid API key")
 
+    name = request.rel_url.query.get("formatter", "")
+    try:
+        window = coalesce.window(request.rel_url.query, name)
+    except ValueError:
+        return utils.create_json_response(
+            HTTPStatus.BAD_REQUEST,
+            "Invalid coalesce window",
+        )
+    if window > 0 and "formatted_body" not in data:
+        for room_id in data["room_id"]:
+            coalesce.add(room_id, name, data, window, send_digest)
+        return utils.create_json_response(HTTPStatus.ACCEPTED, "Coalesced")
+
     if "formatted_body" in data:
-        formatted_body = data["formatted_body"]
+        contents = [split.message(data["body"], data["formatted_body"])]
+        if not split.fits(contents[0]):
+            return utils.create_json_response(
+                HTTPStatus.REQUEST_ENTITY_TOO_LARGE,
+                "Message too large",
+            )
+    else:
+        with metrics.STAGE_SECONDS.time(stage="markdown"):
+            contents = await split.fit(data["body"], split.policy(name))
+
+    # alerts can only be edited if they fit in a single message
+    if conf.EDIT_ALERTS and len(contents) == 1:
+        fingerprint = edits.fingerprint(data)
+        if fingerprint is not None:
+            contents[0][edits.FINGERPRINT] = fingerprint
+    return data["room_id"], contents
+
+
+def room_list(room_ids):
+    """Get a list of rooms from a room_id, a list of them, or comma separated ones."""
+    if not isinstance(room_ids, list):
+        room_ids = [room_ids]
+    rooms = (room.strip() for value in room_ids for room in str(value).split(","))
+    return list(dict.fromkeys(room for room in rooms if room))
+
+
+def overall_status(results):
+    """Get the common status of many results, or 207 if they differ."""
+    statuses = {result["status"] for result in results}
+    return statuses.pop() if len(statuses) == 1 else HTTPStatus.MULTI_STATUS
+
+
+def aggregate(results):
+    """Aggregate results by room."""
+    return {"status": overall_status(results.values()), "ret": results}
+
+
+async def send_room(room_id, contents):
+    """Deliver messages in order now, or queue them with conf.ASYNC_DELIVERY."""
+    if conf.ASYNC_DELIVERY:
+        for content in contents:
+            await delivery.submit(room_id, content)
+        return utils.create_json_response(HTTPStatus.ACCEPTED, "Accepted")
+    for content in contents:
+        resp = await utils.deliver(room_id, content)
+        if resp.status != HTTPStatus.OK:
+            break
+    return resp
+
+
+async def send_digest(room_id, formatter, body):
+    """Render and deliver a digest of coalesced messages."""
+    with metrics.STAGE_SECONDS.time(stage="markdown"):
+        contents = await split.fit(body, split.policy(formatter))
+    resp = await send_room(room_id, contents)
+    if resp.status >= HTTPStatus.MULTIPLE_CHOICES:
+        msg = f"Digest delivery failed in {room_id=}: {resp.text}"
+        LOGGER.error(msg)
+
+
+async def gather_limited(coros):
+    """Run coroutines concurrently, but not more than conf.FANOUT_CONCURRENCY."""
+    semaphore = asyncio.Semaphore(conf.FANOUT_CONCURRENCY)
+
+    async def limited(coro):
+        async with semaphore:
+            return await coro
+
+    return await asyncio.gather(*(limited(coro) for coro in coros))
+
+
+async def send(room_ids, contents):
+    """Deliver a message to one room, or concurrently to many rooms."""
+    if len(room_ids) == 1:
+        return await send_room(room_ids[0], contents)
+
+    async def send_one(room_id):
+        return utils.response_data(await send_room(room_id, contents))
+
+    results = await gather_limited(send_one(room_id) for room_id in room_ids)
+    return utils.create_json_response(**aggregate(dict(zip(room_ids, results))))
+
+
+async def handle_batch(request, items, digest):
+    """Handle many messages in a single request.
+
+    The API key is checked once for the whole batch. Then, rooms are delivered
+    concurrently, and messages for a given room are delivered in order.
+    """
+    if not items:
+        return utils.create_json_response(HTTPStatus.BAD_REQUEST, "Empty batch")
+
+    if "key" in request.rel_url.query:
+        keys = {request.rel_url.query["key"]}
     else:
-        formatted_body = markdown(str(data["body"]), extensions=["extra"])
-
-    # try to join room first -> non none response means error
-    resp = await utils.join_room(data["room_id"])
-    if resp is not None:
-        return resp
-
-    content = {
-        "msgtype": "m.text",
-        "body": data["body"],
-        "format": "org.matrix.custom.html",
-        "formatted_body": formatted_body,
-    }
-    return await utils.send_room_message(data["room_id"], content)
+        keys = {item.get("key") for item in items if isinstance(item, dict)}
+    if keys != {conf.API_KEY}:
+        return utils.create_json_response(HTTPStatus.UNAUTHORIZED, "Invalid API key")
+
+    results = [None] * len(items)
+    by_room = [{} for _ in items]  # results of each message, by room
+    rooms = defaultdict(list)  # room_id -> [(index, contents)], in order
+    for index, item in enumerate(items):
+        if not isinstance(item, dict):
+            results[index] = {"status": HTTPStatus.BAD_REQUEST, "ret": "Invalid JSON"}
+            continue
+        item["key"] = conf.API_KEY
+        prepared = await prepare(request, item, digest)
+        if isinstance(prepared, web.Response):
+            results[index] = utils.response_data(prepared)
+        else:
+            room_ids, contents = prepared
+            for room_id in room_ids:
+                rooms[room_id].append((index, contents))
+
+    async def send_in_order(room_id, messages):
+        for index, contents in messages:
+            resp = await send_room(room_id, contents)
+            by_room[index][room_id] = utils.response_data(resp)
+
+    await gather_limited(
+        send_in_order(room_id, messages) for room_id, messages in rooms.items()
+    )
+
+    for index, result in enumerate(by_room):
+        if len(result) == 1:
+            results[index] = result.popitem()[1]
+        elif result:
+            results[index] = aggregate(result)
+    return utils.create_json_response(overall_status(results), results)
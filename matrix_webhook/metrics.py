@@ -0,0 +1,163 @@
+"""Matrix Webhook metrics, in the Prometheus text format.
+
+ref. https://prometheus.io/docs/instrumenting/exposition_formats/
+"""
+
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+REGISTRY = []
+
+
+def escape(value):
+    """Escape a label value."""
+    return str(value).replace("\\", r"\\").replace('"', r"\"").replace("\n", r"\n")
+
+
+def format_labels(labels):
+    """Format a sorted tuple of (name, value) labels."""
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{k}="{escape(v)}"' for k, v in labels) + "}"
+
+
+class Metric:
+    """Base class for metrics, with values for each set of labels.
+
+    If `function` is given, it is called on exposition to get the value.
+    """
+
+    type = "untyped"
+
+    def __init__(self, name, documentation, function=None):
+        """Register the metric."""
+        self.name = name
+        self.documentation = documentation
+        self.function = function
+        self.values = defaultdict(float)
+        REGISTRY.append(self)
+
+    def samples(self):
+        """Get (suffix, labels, value) for all the values of this metric."""
+        if self.function is not None:
+            return [("", (), self.function())]
+        return [("", labels, value) for labels, value in self.values.items()]
+
+    def expose(self):
+        """Get the lines for this metric."""
+        lines = [
+            f"# HELP {self.name} {self.documentation}",
+            f"# TYPE {self.name} {self.type}",
+        ]
+        for suffix, labels, value in self.samples():
+            lines.append(f"{self.name}{suffix}{format_labels(labels)} {value}")
+        return lines
+
+
+class Counter(Metric):
+    """A value which only goes up."""
+
+    type = "counter"
+
+    def inc(self, amount=1, **labels):
+        """Increment the counter."""
+        self.values[tuple(sorted(labels.items()))] += amount
+
+
+class Gauge(Metric):
+    """A value which goes up and down."""
+
+    type = "gauge"
+
+    def set(self, value, **labels):
+        """Set the gauge."""
+        self.values[tuple(sorted(labels.items()))] = value
+
+    def inc(self, amount=1, **labels):
+        """Increment the gauge."""
+        self.values[tuple(sorted(labels.items()))] += amount
+
+    def dec(self, amount=1, **labels):
+        """Decrement the gauge."""
+        self.values[tuple(sorted(labels.items()))] -= amount
+
+
+class Histogram(Metric):
+    """Count observations in buckets."""
+
+    type = "histogram"
+
+    def __init__(self, name, documentation, buckets=BUCKETS):
+        """Register the histogram."""
+        super().__init__(name, documentation)
+        self.buckets = buckets
+        self.counts = defaultdict(lambda: [0] * len(self.buckets))
+        self.sums = defaultdict(float)
+        self.totals = defaultdict(int)
+
+    def observe(self, value, **labels):
+        """Count a value."""
+        key = tuple(sorted(labels.items()))
+        counts = self.counts[key]
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                counts[i] += 1
+        self.sums[key] += value
+        self.totals[key] += 1
+
+    @contextmanager
+    def time(self, **labels):
+        """Observe the duration of a block."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def samples(self):
+        """Get the bucket, sum and count samples."""
+        samples = []
+        for key, counts in self.counts.items():
+            for bound, count in zip(self.buckets, counts):
+                samples.append(("_bucket", (*key, ("le", bound)), count))
+            samples.append(("_bucket", (*key, ("le", "+Inf")), self.totals[key]))
+            samples.append(("_sum", key, self.sums[key]))
+            samples.append(("_count", key, self.totals[key]))
+        return samples
+
+
+def expose():
+    """Get all the metrics, in the Prometheus text format."""
+    lines = []
+    for metric in REGISTRY:
+        lines.extend(metric.expose())
+    return "\n".join(lines) + "\n"
+
+
+REQUESTS = Counter(
+    "matrix_webhook_requests_total",
+    "Webhooks handled, by formatter and HTTP status.",
+)
+IN_FLIGHT = Gauge(
+    "matrix_webhook_requests_in_flight",
+    "Webhooks currently being handled.",
+)
+STAGE_SECONDS = Histogram(
+    "matrix_webhook_stage_seconds",
+    "Time spent in each stage of a webhook: parse, formatter, markdown, join, send.",
+)
+FORMATTER_SECONDS = Histogram(
+    "matrix_webhook_formatter_seconds",
+    "Time spent in each formatter.",
+)
+HOMESERVER_ERRORS = Counter(
+    "matrix_webhook_homeserver_errors_total",
+    "Errors from the homeserver, by Matrix errcode.",
+)
+HOMESERVER_RETRIES = Counter(
+    "matrix_webhook_homeserver_retries_total",
+    "Requests to the homeserver which were tried again.",
+)
@@ -0,0 +1,142 @@
+"""Matrix Webhook persistent outbox.
+
+Accepted messages are stored in a SQLite database before the webhook is answered, and
+removed once delivered, so that they survive restarts and homeserver outages. Messages
+which can't be delivered are moved to the dead_letters table, with their last error.
+
+Writes are grouped: everything submitted while a commit is running is committed
+together in the next transaction, so that we don't pay one fsync per message.
+"""
+
+import asyncio
+import json
+import logging
+import sqlite3
+from concurrent.futures import ThreadPoolExecutor
+
+from . import conf
+
+LOGGER = logging.getLogger("matrix_webhook.outbox")
+# The sqlite connection is only used from this thread
+EXECUTOR = ThreadPoolExecutor(max_workers=1, thread_name_prefix="outbox")
+DB = None
+PENDING = []  # (room_id, content, future) waiting for the next commit
+ACKED = []  # ids of delivered messages waiting for the next commit
+DEAD = []  # (id, error) of undeliverable messages waiting for the next commit
+FLUSHER = None
+
+
+def _open(path):
+    """Open the database, and create its table if needed."""
+    db = sqlite3.connect(path, check_same_thread=False)
+    db.execute("PRAGMA journal_mode=WAL")
+    db.execute("PRAGMA synchronous=FULL")
+    db.execute(
+        "CREATE TABLE IF NOT EXISTS outbox "
+        "(id INTEGER PRIMARY KEY AUTOINCREMENT, room_id TEXT, content TEXT)",
+    )
+    db.execute(
+        "CREATE TABLE IF NOT EXISTS dead_letters "
+        "(id INTEGER PRIMARY KEY, room_id TEXT, content TEXT, error TEXT)",
+    )
+    db.commit()
+    return db
+
+
+def _load():
+    """Get all undelivered messages, oldest first."""
+    rows = DB.execute("SELECT id, room_id, content FROM outbox ORDER BY id")
+    return [(id_, room_id, json.loads(content)) for id_, room_id, content in rows]
+
+
+def _commit(messages, acked, dead):
+    """Store new messages, remove delivered ones and move dead ones, in a transaction."""
+    with DB:
+        ids = [
+            DB.execute(
+                "INSERT INTO outbox (room_id, content) VALUES (?, ?)",
+                (room_id, json.dumps(content)),
+            ).lastrowid
+            for room_id, content in messages
+        ]
+        DB.executemany(
+            "INSERT INTO dead_letters (id, room_id, content, error) "
+            "SELECT id, room_id, content, ? FROM outbox WHERE id = ?",
+            [(error, id_) for id_, error in dead],
+        )
+        acked = acked + [id_ for id_, _ in dead]
+        DB.executemany("DELETE FROM outbox WHERE id = ?", [(id_,) for id_ in acked])
+    return ids
+
+
+async def _flush():
+    """Commit everything pending, until there is nothing left."""
+    loop = asyncio.get_event_loop()
+    while PENDING or ACKED or DEAD:
+        pending, acked, dead = PENDING[:], ACKED[:], DEAD[:]
+        PENDING.clear()
+        ACKED.clear()
+        DEAD.clear()
+        messages = [(room_id, content) for room_id, content, _ in pending]
+        try:
+            ids = await loop.run_in_executor(EXECUTOR, _commit, messages, acked, dead)
+        except sqlite3.Error as e:
+            msg = f"Outbox commit failed: {e}"
+            LOGGER.error(msg)
+            for _, _, future in pending:
+                future.set_exception(e)
+            # those will be delivered again on next start
+            continue
+        msg = f"Outbox commit: {len(ids)} new, {len(acked)} delivered, {len(dead)} dead"
+        LOGGER.debug(msg)
+        for (_, _, future), id_ in zip(pending, ids):
+            future.set_result(id_)
+
+
+def _schedule():
+    """Ensure a flusher is running."""
+    global FLUSHER
+    if FLUSHER is None or FLUSHER.done():
+        FLUSHER = asyncio.ensure_future(_flush())
+
+
+async def add(room_id, content):
+    """Store a message, and return its outbox id once it is on disk."""
+    future = asyncio.get_event_loop().create_future()
+    PENDING.append((room_id, content, future))
+    _schedule()
+    return await future
+
+
+def ack(id_):
+    """Forget a delivered message."""
+    ACKED.append(id_)
+    _schedule()
+
+
+def dead(id_, error):
+    """Move an undeliverable message to the dead letters."""
+    DEAD.append((id_, error))
+    _schedule()
+
+
+async def open_outbox():
+    """Open the outbox, and return the undelivered messages."""
+    global DB
+    loop = asyncio.get_event_loop()
+    DB = await loop.run_in_executor(EXECUTOR, _open, conf.OUTBOX)
+    messages = await loop.run_in_executor(EXECUTOR, _load)
+    msg = f"Opened outbox {conf.OUTBOX} with {len(messages)} undelivered messages"
+    LOGGER.info(msg)
+    return messages
+
+
+async def close_outbox():
+    """Commit what is left, and close the outbox."""
+    global DB
+    if DB is None:
+        return
+    _schedule()
+    await FLUSHER
+    await asyncio.get_event_loop().run_in_executor(EXECUTOR, DB.close)
+    DB = None
@@ -0,0 +1,134 @@
+"""Matrix Webhook rate limiting.
+
+Messages are paced by token buckets: one for each account, and one per room. When the
+homeserver answers M_LIMIT_EXCEEDED, the account bucket is blocked for retry_after_ms,
+and its rate is set to what the homeserver allows. Then, it slowly increases again
+with each successful request, until the next limit, which cuts it down.
+"""
+
+import asyncio
+import logging
+import time
+
+from . import conf, metrics
+
+LOGGER = logging.getLogger("matrix_webhook.ratelimit")
+RECOVERY = 1.01  # rate increase on each success after a limit
+DECREASE = 0.5  # rate decrease on each new limit
+LIMITED = metrics.Counter(
+    "matrix_webhook_rate_limited_total",
+    "M_LIMIT_EXCEEDED answers from the homeserver.",
+)
+WAITS = metrics.Counter(
+    "matrix_webhook_rate_limit_waits_total",
+    "Requests which waited for a rate limit.",
+)
+WAIT_SECONDS = metrics.Counter(
+    "matrix_webhook_rate_limit_wait_seconds_total",
+    "Time spent waiting for rate limits.",
+)
+
+
+class TokenBucket:
+    """Allow `rate` requests per second, with bursts of `burst` requests.
+
+    A rate of 0 means unlimited, until the homeserver says otherwise.
+    """
+
+    def __init__(self, name, rate=0, burst=1):
+        """Start with a full bucket."""
+        self.name = name
+        self.ceiling = rate
+        self.rate = rate
+        self.burst = max(burst, 1)
+        self.tokens = self.burst
+        self.updated = time.monotonic()
+        self.blocked_until = 0
+
+    def refill(self, now):
+        """Add the tokens earned since the last update."""
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def delay(self):
+        """Take a token if there is one, or say how long to wait for it."""
+        now = time.monotonic()
+        if self.blocked_until > now:
+            return self.blocked_until - now
+        if not self.rate:
+            return 0
+        self.refill(now)
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0
+        return (1 - self.tokens) / self.rate
+
+    async def acquire(self):
+        """Wait for a token, and return how long we waited."""
+        waited = 0
+        while (delay := self.delay()) > 0:
+            waited += delay
+            await asyncio.sleep(delay)
+        if waited:
+            WAITS.inc()
+            WAIT_SECONDS.inc(waited)
+            msg = f"Waited {waited:.3f}s for {self.name} rate limit"
+            LOGGER.info(msg)
+        return waited
+
+    def limited(self, retry_after_ms):
+        """Adapt to a M_LIMIT_EXCEEDED from the homeserver."""
+        retry_after = (retry_after_ms or 1000) / 1000
+        now = time.monotonic()
+        if self.blocked_until <= now:
+            # retry_after only tells when the next request is allowed, which is sooner
+            # than 1 / rate when we are just above the limit, so we also slow down.
+            # Other limits while blocked are for requests sent before this one.
+            allowed = 1 / retry_after
+            self.rate = min(self.rate * DECREASE, allowed) if self.rate else allowed
+        self.blocked_until = max(self.blocked_until, now + retry_after)
+        self.tokens = 0
+        self.updated = now
+        msg = (
+            f"Rate limited on {self.name}: waiting {retry_after:.3f}s, "
+            f"then sending {self.rate:.3f} messages per second"
+        )
+        LOGGER.warning(msg)
+
+    def succeeded(self):
+        """Slowly get back to the configured rate after a limit."""
+        if self.rate and self.rate != self.ceiling:
+            self.rate *= RECOVERY
+            if self.ceiling:
+                self.rate = min(self.rate, self.ceiling)
+
+
+ROOMS = {}  # room_id -> TokenBucket
+
+
+def room_bucket(room_id):
+    """Get the bucket of a room."""
+    if room_id not in ROOMS:
+        ROOMS[room_id] = TokenBucket(
+            room_id,
+            conf.ROOM_RATE_LIMIT,
+            conf.RATE_LIMIT_BURST,
+        )
+    return ROOMS[room_id]
+
+
+async def acquire(room_id, bucket):
+    """Wait until we can send a request for this room, and return how long it took."""
+    waited = await bucket.acquire()
+    if room_id is not None and conf.ROOM_RATE_LIMIT:
+        waited += await room_bucket(room_id).acquire()
+    return waited
+
+
+def limited(resp, bucket):
+    """Check if an error response is a rate limit, and adapt to it."""
+    if resp.status_code != "M_LIMIT_EXCEEDED":
+        return False
+    LIMITED.inc()
+    bucket.limited(resp.retry_after_ms)
+    return True
@@ -0,0 +1,59 @@
+"""Matrix Webhook markdown rendering.
+
+Markdown instances are reused (one per thread, reset before each conversion), and
+rendered bodies are kept in a LRU cache, as the same bodies tend to be sent again
+and again. Big bodies are rendered in a thread, to keep the event loop responsive.
+"""
+
+import asyncio
+import hashlib
+import logging
+import threading
+from collections import OrderedDict
+
+from markdown import Markdown
+
+from . import conf, metrics
+
+LOGGER = logging.getLogger("matrix_webhook.render")
+CACHE = OrderedDict()  # sha256 of the body -> rendered HTML
+LOOKUPS = metrics.Counter(
+    "matrix_webhook_markdown_cache_total",
+    "Lookups in the rendered markdown cache, by result: hit or miss.",
+)
+THREADED = metrics.Counter(
+    "matrix_webhook_markdown_threaded_total",
+    "Markdown bodies rendered in a thread.",
+)
+LOCAL = threading.local()
+
+
+def convert(body):
+    """Render markdown with the Markdown instance of the current thread."""
+    if not hasattr(LOCAL, "markdown"):
+        LOCAL.markdown = Markdown(extensions=["extra"])
+    return LOCAL.markdown.reset().convert(body)
+
+
+async def render(body):
+    """Render markdown, from the cache if possible."""
+    key = hashlib.sha256(body.encode()).digest()
+    if key in CACHE:
+        LOOKUPS.inc(result="hit")
+        CACHE.move_to_end(key)
+        return CACHE[key]
+
+    LOOKUPS.inc(result="miss")
+    if conf.MARKDOWN_THREAD_THRESHOLD and len(body) > conf.MARKDOWN_THREAD_THRESHOLD:
+        THREADED.inc()
+        msg = f"Rendering {len(body)} characters in a thread"
+        LOGGER.debug(msg)
+        html = await asyncio.get_event_loop().run_in_executor(None, convert, body)
+    else:
+        html = convert(body)
+
+    if conf.MARKDOWN_CACHE_SIZE:
+        CACHE[key] = html
+        while len(CACHE) > conf.MARKDOWN_CACHE_SIZE:
+            CACHE.popitem(last=False)
+    return html
@@ -0,0 +1,101 @@
+"""Matrix Webhook retry policy and circuit breaker.
+
+Failed requests to the homeserver are retried with an exponential backoff and full
+jitter, up to conf.RETRY_ATTEMPTS attempts and conf.RETRY_DEADLINE seconds.
+
+After conf.BREAKER_THRESHOLD consecutive failures, the circuit breaker opens: requests
+fail fast for conf.BREAKER_TIMEOUT seconds. Then, it lets a single probe request go
+through (half-open). If it succeeds, the breaker closes again. Otherwise it opens again.
+The probe keeps its slot through its own retries, and releases it if it ends without
+telling either, eg. when it is cancelled.
+"""
+
+import logging
+import random
+import time
+
+from . import conf, metrics
+
+LOGGER = logging.getLogger("matrix_webhook.retry")
+CLOSED, OPEN, HALF_OPEN = "closed", "open", "half-open"
+
+
+def backoff(attempt):
+    """Get the delay before the next attempt, after `attempt` failures."""
+    ceiling = min(conf.RETRY_MAX_DELAY, conf.RETRY_BASE_DELAY * 2**attempt)
+    return random.uniform(0, ceiling)
+
+
+class CircuitBreaker:
+    """Fail fast while the homeserver is down."""
+
+    def __init__(self, threshold, timeout):
+        """Start closed."""
+        self.threshold = threshold
+        self.timeout = timeout
+        self.state = CLOSED
+        self.failures = 0
+        self.opened_at = 0
+        self.probing = False
+
+    def allow(self, probe=False):
+        """Check if a request can be sent now.
+
+        `probe` is True for the request which already holds the half-open probe slot.
+        """
+        if self.state == OPEN and time.monotonic() >= self.opened_at + self.timeout:
+            LOGGER.info("Circuit breaker half-open")
+            self.state = HALF_OPEN
+            self.probing = False
+        if self.state == HALF_OPEN:
+            if probe:
+                return True
+            if self.probing:
+                return False
+            self.probing = True
+            return True
+        return self.state == CLOSED
+
+    def is_probe(self):
+        """Check if the request which was just allowed is the half-open probe."""
+        return self.state == HALF_OPEN
+
+    def release(self):
+        """Let another request probe, as the probe ended without success nor failure."""
+        if self.state == HALF_OPEN:
+            self.probing = False
+
+    def retry_after(self):
+        """Get the number of seconds before the next probe."""
+        if self.state == CLOSED:
+            return 0
+        return max(0, self.opened_at + self.timeout - time.monotonic())
+
+    def success(self):
+        """Record that the homeserver answered."""
+        if self.state != CLOSED:
+            LOGGER.info("Circuit breaker closed")
+        self.state = CLOSED
+        self.failures = 0
+        self.probing = False
+
+    def failure(self):
+        """Record that the homeserver did not answer, or failed."""
+        self.failures += 1
+        if self.state == HALF_OPEN or (
+            self.state == CLOSED and self.failures >= self.threshold
+        ):
+            msg = f"Circuit breaker open after {self.failures} failures"
+            LOGGER.error(msg)
+            self.state = OPEN
+            self.opened_at = time.monotonic()
+            self.probing = False
+
+
+BREAKER = CircuitBreaker(conf.BREAKER_THRESHOLD, conf.BREAKER_TIMEOUT)
+STATES = {CLOSED: 0, HALF_OPEN: 1, OPEN: 2}
+metrics.Gauge(
+    "matrix_webhook_breaker_state",
+    "State of the circuit breaker: 0 for closed, 1 for half-open, 2 for open.",
+    function=lambda: STATES[BREAKER.state],
+)
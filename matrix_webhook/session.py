@@ -0,0 +1,147 @@
+"""Matrix Webhook HTTP sessions to the homeserver.
+
+Each bot account gets an aiohttp session with a tuned connection pool: connections are
+kept alive between bursts, DNS answers are cached, and a few connections are opened at
+startup, so that webhooks don't wait for TCP and TLS handshakes.
+"""
+
+import asyncio
+import logging
+
+from aiohttp import ClientSession, ClientTimeout, TCPConnector, TraceConfig
+from aiohttp_socks import ProxyConnector
+from nio import AsyncClient
+
+from . import conf, metrics
+
+LOGGER = logging.getLogger("matrix_webhook.session")
+TIMEOUT = ClientTimeout(
+    total=conf.HTTP_TIMEOUT or None,
+    connect=conf.HTTP_CONNECT_TIMEOUT or None,
+    sock_read=conf.HTTP_READ_TIMEOUT or None,
+)
+CONNECTIONS = metrics.Counter(
+    "matrix_webhook_http_connections_total",
+    "Connections to the homeserver got by requests, by origin: created or reused.",
+)
+POOL_WAITS = metrics.Counter(
+    "matrix_webhook_http_pool_waits_total",
+    "Requests which waited for a free connection, as the pool was full.",
+)
+DNS_LOOKUPS = metrics.Counter(
+    "matrix_webhook_http_dns_cache_total",
+    "Lookups in the DNS cache, by result: hit or miss.",
+)
+CONNECTORS = []  # connection pools of all the accounts
+
+
+def idle_connections():
+    """Count the connections kept alive in the pools, waiting for requests."""
+    return sum(len(conns) for pool in CONNECTORS for conns in pool._conns.values())
+
+
+metrics.Gauge(
+    "matrix_webhook_http_connections_idle",
+    "Connections to the homeserver kept alive in the pools, waiting for requests.",
+    function=idle_connections,
+)
+metrics.Gauge(
+    "matrix_webhook_http_connections_open",
+    "Connections to the homeserver, in use or idle.",
+    function=lambda: idle_connections() + sum(len(c._acquired) for c in CONNECTORS),
+)
+
+
+class Client(AsyncClient):
+    """A nio client, whose requests use all our timeouts."""
+
+    async def send(
+        self,
+        method,
+        path,
+        data=None,
+        headers=None,
+        trace_context=None,
+        timeout=None,
+    ):
+        """Send a request, with TIMEOUT unless another timeout is given.
+
+        nio would give its request_timeout, which aiohttp takes as a total timeout only.
+        """
+        if timeout is None:
+            timeout = TIMEOUT
+        return await super().send(method, path, data, headers, trace_context, timeout)
+
+
+async def on_connection_create_end(_session, _context, _params):
+    """Count new connections."""
+    CONNECTIONS.inc(origin="created")
+
+
+async def on_connection_reuseconn(_session, _context, _params):
+    """Count connections kept alive and used again."""
+    CONNECTIONS.inc(origin="reused")
+
+
+async def on_connection_queued_start(_session, _context, _params):
+    """Count requests waiting for the pool."""
+    POOL_WAITS.inc()
+
+
+async def on_dns_cache_hit(_session, _context, _params):
+    """Count DNS cache hits."""
+    DNS_LOOKUPS.inc(result="hit")
+
+
+async def on_dns_cache_miss(_session, _context, _params):
+    """Count DNS cache misses."""
+    DNS_LOOKUPS.inc(result="miss")
+
+
+TRACE = TraceConfig()
+TRACE.on_connection_create_end.append(on_connection_create_end)
+TRACE.on_connection_reuseconn.append(on_connection_reuseconn)
+TRACE.on_connection_queued_start.append(on_connection_queued_start)
+TRACE.on_dns_cache_hit.append(on_dns_cache_hit)
+TRACE.on_dns_cache_miss.append(on_dns_cache_miss)
+
+
+def create(account):
+    """Give the client of an account a session with our connection pool."""
+    pool = {
+        "limit": 0,
+        "limit_per_host": conf.HTTP_POOL_SIZE,
+        "keepalive_timeout": conf.HTTP_KEEPALIVE,
+        "use_dns_cache": bool(conf.HTTP_DNS_TTL),
+        "ttl_dns_cache": conf.HTTP_DNS_TTL or None,
+    }
+    if conf.PROXY:
+        connector = ProxyConnector.from_url(conf.PROXY, **pool)
+    else:
+        connector = TCPConnector(**pool)
+    CONNECTORS.append(connector)
+    account.client.client_session = ClientSession(
+        connector=connector,
+        timeout=TIMEOUT,
+        trace_configs=[TRACE],
+    )
+
+
+async def warm_up(account):
+    """Open conf.HTTP_WARMUP connections to the homeserver, kept alive in the pool."""
+
+    async def connect():
+        resp = await account.client.send("GET", "/_matrix/client/versions")
+        await resp.read()
+
+    results = await asyncio.gather(
+        *(connect() for _ in range(conf.HTTP_WARMUP)),
+        return_exceptions=True,
+    )
+    errors = [result for result in results if isinstance(result, Exception)]
+    if errors:
+        msg = f"Can't warm up connections for {account.user_id}: {errors[0]!r}"
+        LOGGER.warning(msg)
+    else:
+        msg = f"Opened {len(results)} connections for {account.user_id}"
+        LOGGER.debug(msg)
@@ -0,0 +1,160 @@
+"""Matrix Webhook message size.
+
+Matrix events are limited to 65536 bytes, so messages which would be too large are
+either split in several ordered messages on block boundaries, or truncated, depending
+on the policy of their formatter. Bodies are cut before being rendered, so huge bodies
+are not rendered in full for nothing.
+"""
+
+import logging
+
+from . import codec, conf, metrics, render
+
+LOGGER = logging.getLogger("matrix_webhook.split")
+# serialized JSON can't be more than 6 bytes per character, eg. "\u0000"
+MAX_BYTES_PER_CHAR = 6
+MIN_CHUNK = 1024  # stop cutting chunks smaller than this, in bytes
+OVERSIZED = metrics.Counter(
+    "matrix_webhook_oversized_total",
+    "Messages too large for a single event, by policy: split or truncate.",
+)
+
+
+def message(body, formatted_body):
+    """Create the content of a message."""
+    return {
+        "msgtype": "m.text",
+        "body": body,
+        "format": "org.matrix.custom.html",
+        "formatted_body": formatted_body,
+    }
+
+
+def fits(content):
+    """Check if a message is small enough for a Matrix event."""
+    length = len(str(content["body"])) + len(str(content["formatted_body"]))
+    if length * MAX_BYTES_PER_CHAR < conf.MAX_MESSAGE_SIZE:
+        # no need to serialize it
+        return True
+    return len(codec.dumps(content)) <= conf.MAX_MESSAGE_SIZE
+
+
+def policy(formatter):
+    """Get what to do with messages too large from this formatter."""
+    return conf.OVERSIZE_POLICY.get(formatter, conf.OVERSIZE)
+
+
+def closing(fence):
+    """Get the line closing a fenced code block, from its opening line."""
+    marker = fence.lstrip()
+    return marker[0] * (len(marker) - len(marker.lstrip(marker[0])))
+
+
+def chunks(body, limit):
+    """Cut a body in chunks of at most `limit` bytes.
+
+    Chunks are cut after a blank line if there is one in their second half, or else
+    after any line, out of fenced code blocks. If the last such line is in the first
+    half, the chunk is cut in the fenced code block instead, which is closed at the end
+    of this chunk and opened again in the next one. Lines too long are cut anywhere.
+    """
+    chunk, size = [], 0
+    block = line_end = (
+        0  # where we can cut the chunk out of fenced code blocks, in lines
+    )
+    fence = close = None  # opening and closing lines of the current fenced code block
+    for line in body.split("\n"):
+        encoded = line.encode()
+        is_fence = line.lstrip().startswith(("```", "~~~"))
+        # room to open and close the current fenced code block around a line
+        wrap = len(fence.encode()) + len(close) + 2 if fence else 0
+        if len(encoded) + wrap >= limit:
+            # a single huge line: cut it anywhere, but not in an UTF-8 character
+            if len(chunk) > bool(fence):
+                yield "\n".join([*chunk, close] if fence else chunk)
+            while len(encoded) + wrap >= limit:
+                piece = encoded[: limit - 1 - wrap].decode(errors="ignore")
+                yield f"{fence}\n{piece}\n{close}" if fence else piece
+                encoded = encoded[len(piece.encode()) :]
+            chunk = [fence] if fence else []
+            size = wrap - len(close) - 1 if fence else 0
+            block = line_end = 0
+            if not encoded:
+                continue
+            line = encoded.decode()
+        # room to close the fenced code block at the end of this chunk
+        if fence:
+            reserve = len(close) + 1
+        else:
+            reserve = len(closing(line)) + 1 if is_fence else 0
+        while size + len(encoded) + 1 + reserve > limit:
+            cut = block if block > len(chunk) // 2 else line_end
+            if fence and cut <= len(chunk) // 2:
+                yield "\n".join([*chunk, close])
+                chunk, size = [fence], len(fence.encode()) + 1
+            else:
+                cut = cut or len(chunk)
+                yield "\n".join(chunk[:cut])
+                chunk = chunk[cut:]
+                size = sum(len(c.encode()) + 1 for c in chunk)
+            block = line_end = 0
+        chunk.append(line)
+        size += len(encoded) + 1
+        if is_fence and fence:
+            fence = close = None
+        elif is_fence:
+            # a huge opening line is not repeated in the next chunks
+            fence = line if len(encoded) < limit // 4 else line.lstrip()[:3]
+            close = closing(fence)
+        if not fence:
+            line_end = len(chunk)
+            if not line.strip():
+                block = len(chunk)
+    if chunk:
+        yield "\n".join(chunk)
+
+
+async def render_chunks(body, limit):
+    """Render the chunks of a body, cutting them again if their HTML is too large."""
+    contents = []
+    for chunk in chunks(body, limit):
+        content = message(chunk, await render.render(chunk))
+        if fits(content) or limit < MIN_CHUNK:
+            contents.append(content)
+        else:
+            contents += await render_chunks(chunk, limit // 2)
+    return contents
+
+
+async def truncate(body, limit):
+    """Keep the beginning of a body, and tell how many lines were left out."""
+    while True:
+        kept = next(chunks(body, limit))
+        # kept is the beginning of the body, unless a fenced code block was closed
+        end = len(kept) if body.startswith(kept) else kept.rindex("\n")
+        rest = body[end:].lstrip("\n")
+        more = rest.count("\n") + 1 if rest else 0
+        text = f"{kept}\n\n({more} more)" if more else kept
+        content = message(text, await render.render(text))
+        if fits(content) or limit < MIN_CHUNK:
+            return content
+        limit //= 2
+
+
+async def fit(body, policy="split"):
+    """Render a body, as a list of messages small enough for Matrix events."""
+    text = str(body)
+    # the HTML is usually larger than the markdown, and both are sent
+    if len(text.encode()) * 2 < conf.MAX_MESSAGE_SIZE:
+        content = message(body, await render.render(text))
+        if fits(content):
+            return [content]
+
+    OVERSIZED.inc(policy=policy)
+    limit = conf.MAX_MESSAGE_SIZE // 3
+    if policy == "truncate":
+        return [await truncate(text, limit)]
+    contents = await render_chunks(text, limit)
+    msg = f"Message of {len(text)} characters split in {len(contents)} messages"
+    LOGGER.info(msg)
+    return contents
@@ -1,25 +1,84 @@
 """Matrix Webhook utils."""
 
+import asyncio
+import fcntl
+import json
 import logging
-from collections import defaultdict
+import math
+import os
+import time
+from collections import OrderedDict, defaultdict
 from http import HTTPStatus
+from uuid import uuid4
 
-from aiohttp import web
-from nio import AsyncClient
+from aiohttp import ClientConnectionError, ClientError, web
 from nio.exceptions import LocalProtocolError
-from nio.responses import JoinError, RoomSendError
+from nio.responses import (
+    JoinedRoomsResponse,
+    JoinError,
+    LoginResponse,
+    RoomResolveAliasError,
+    RoomSendError,
+)
 
-from . import conf
+from . import accounts, codec, conf, edits, metrics, ratelimit, retry
 
 ERROR_MAP = defaultdict(
     lambda: HTTPStatus.INTERNAL_SERVER_ERROR,
     {
         "M_FORBIDDEN": HTTPStatus.FORBIDDEN,
         "M_CONSENT_NOT_GIVEN": HTTPStatus.FORBIDDEN,
+        "M_LIMIT_EXCEEDED": HTTPStatus.TOO_MANY_REQUESTS,
+        "M_NOT_FOUND": HTTPStatus.NOT_FOUND,
     },
 )
 LOGGER = logging.getLogger("matrix_webhook.utils")
-CLIENT = AsyncClient(conf.MATRIX_URL, conf.MATRIX_ID, proxy=conf.PROXY)
+# Serialize the most common responses once
+CONSTANT_RESPONSES = {
+    (status, ret): codec.dumps({"status": status, "ret": ret})
+    for status, ret in [
+        (HTTPStatus.OK, "OK"),
+        (HTTPStatus.ACCEPTED, "Accepted"),
+        (HTTPStatus.BAD_REQUEST, "Invalid JSON"),
+        (HTTPStatus.UNAUTHORIZED, "Invalid API key"),
+        (HTTPStatus.UNAUTHORIZED, "Invalid SHA-256 HMAC digest"),
+        (HTTPStatus.REQUEST_ENTITY_TOO_LARGE, "Payload too large"),
+        (HTTPStatus.GATEWAY_TIMEOUT, "Homeserver not responding"),
+    ]
+}
+# (room_id, user_id) -> why this account can't post there, and until when
+FORBIDDEN_ROOMS = OrderedDict()
+FORBIDDEN_SIZE = 10000
+FORBIDDEN_ERRCODES = {"M_FORBIDDEN"}
+FORBIDDEN_HITS = metrics.Counter(
+    "matrix_webhook_forbidden_rooms_hits_total",
+    "Messages answered from the forbidden rooms cache.",
+)
+metrics.Gauge(
+    "matrix_webhook_forbidden_rooms",
+    "Rooms and accounts in the forbidden rooms cache.",
+    function=lambda: len(FORBIDDEN_ROOMS),
+)
+# alias -> (room_id, or None with the error if unknown, time.monotonic() of resolution)
+ALIASES = OrderedDict()
+ALIASES_SIZE = 10000
+ALIAS_LOOKUPS = metrics.Counter(
+    "matrix_webhook_alias_cache_total",
+    "Lookups in the room alias cache, by result: hit, negative (hit) or miss.",
+)
+ALIAS_AGE = metrics.Histogram(
+    "matrix_webhook_alias_age_seconds",
+    "Age of the room aliases served from the cache.",
+    buckets=(1, 10, 60, 300, 900, 1800, 3600, 7200, 21600, 86400),
+)
+ALIAS_CHANGES = metrics.Counter(
+    "matrix_webhook_alias_changes_total",
+    "Room aliases which were resolved again to another room than the cached one.",
+)
+REFRESH_MARGIN = 0.8  # refresh access tokens after 80% of their lifetime
+TOKEN_FILE = None  # where workers share their access token, see app.supervise()
+TOKEN_FILE_SIZE = 1 << 20
+REFRESHES = set()  # running token refreshes
 
 
 def error_map(resp):
@@ -31,67 +90,581 @@ def error_map(resp):
     return ERROR_MAP[resp.status_code]
 
 
-def create_json_response(status, ret):
+def error_response(resp):
+    """Create a JSON response for a nio error, with its errcode as resp["errcode"]."""
+    response = create_json_response(error_map(resp), resp.message)
+    response["errcode"] = resp.status_code
+    return response
+
+
+def create_json_response(status, ret, headers=None, **extra):
     """Create a JSON response."""
     msg = f"Creating json response: {status=}, {ret=}"
     LOGGER.debug(msg)
-    response_data = {"status": status, "ret": ret}
-    return web.json_response(response_data, status=status)
+    if isinstance(ret, str) and not extra and (status, ret) in CONSTANT_RESPONSES:
+        body = CONSTANT_RESPONSES[status, ret]
+    else:
+        body = codec.dumps({"status": status, "ret": ret, **extra})
+    return web.Response(
+        body=body,
+        status=status,
+        headers=headers,
+        content_type="application/json",
+    )
+
+
+def response_data(resp):
+    """Get back the data of a JSON response."""
+    return codec.loads(resp.body)
+
+
+def is_joined(account, room_id):
+    """Check if the room was joined recently enough to skip a new join."""
+    joined = account.joined_rooms.get(room_id)
+    return joined is not None and time.monotonic() - joined < conf.JOINED_ROOMS_TTL
+
+
+def forget_room(account, room_id):
+    """Invalidate the joined rooms cache of an account for this room."""
+    msg = f"Forget joined room {room_id=} for {account.user_id}"
+    LOGGER.debug(msg)
+    account.joined_rooms.pop(room_id, None)
+
+
+def not_in_room(resp):
+    """Check if a send error means that we are not (or not anymore) in the room."""
+    return resp.status_code == "M_FORBIDDEN" or "not in room" in resp.message
+
+
+def forbidden(room_id, account):
+    """Get the cached error response of a room an account can't post to, if any."""
+    entry = FORBIDDEN_ROOMS.get((room_id, account.user_id))
+    if entry is None or entry["until"] < time.monotonic():
+        return None
+    FORBIDDEN_HITS.inc()
+    return web.Response(
+        body=entry["body"],
+        status=entry["status"],
+        content_type="application/json",
+    )
+
+
+def forbid_room(room_id, account, resp):
+    """Remember that an account can't post to a room.
+
+    It won't be tried again for conf.FORBIDDEN_TTL seconds, doubled after each
+    consecutive failure with the same errcode, up to conf.FORBIDDEN_MAX_TTL.
+    Other accounts can still post there.
+    """
+    key = room_id, account.user_id
+    previous = FORBIDDEN_ROOMS.pop(key, None)
+    failures = 1
+    if previous is not None and previous["errcode"] == resp["errcode"]:
+        failures += previous["failures"]
+    ttl = min(conf.FORBIDDEN_TTL * 2 ** (failures - 1), conf.FORBIDDEN_MAX_TTL)
+    msg = (
+        f"{account.user_id} can't post to {room_id=}: {resp['errcode']}, "
+        f"not trying again for {ttl}s"
+    )
+    LOGGER.warning(msg)
+    FORBIDDEN_ROOMS[key] = {
+        "errcode": resp["errcode"],
+        "status": resp.status,
+        "body": resp.body,
+        "failures": failures,
+        "until": time.monotonic() + ttl,
+    }
+    while len(FORBIDDEN_ROOMS) > FORBIDDEN_SIZE:
+        FORBIDDEN_ROOMS.popitem(last=False)
+
+
+def forbidden_rooms():
+    """List the rooms we can't post to, and by which accounts, for the admin endpoint."""
+    now = time.monotonic()
+    rooms = defaultdict(dict)
+    for (room_id, user_id), entry in FORBIDDEN_ROOMS.items():
+        rooms[room_id][user_id] = {
+            "errcode": entry["errcode"],
+            "status": entry["status"],
+            "ret": codec.loads(entry["body"])["ret"],
+            "failures": entry["failures"],
+            "retry_in": max(0, round(entry["until"] - now, 3)),
+        }
+    return dict(rooms)
+
+
+def forget_forbidden(room_ids=None):
+    """Try again some rooms, or all of them, with every account.
+
+    Return the rooms which were forbidden to an account.
+    """
+    forgotten = []
+    for key in list(FORBIDDEN_ROOMS):
+        if room_ids is None or key[0] in room_ids:
+            del FORBIDDEN_ROOMS[key]
+            forgotten.append(key[0])
+    return list(dict.fromkeys(forgotten))
+
+
+def cache_alias(alias, room_id, error=None):
+    """Remember a resolved room alias, or an unknown one with its error."""
+    ALIASES[alias] = (room_id, error, time.monotonic())
+    ALIASES.move_to_end(alias)
+    while len(ALIASES) > ALIASES_SIZE:
+        ALIASES.popitem(last=False)
+
+
+def forget_alias(alias):
+    """Invalidate the room alias cache for this alias."""
+    msg = f"Forget room alias {alias=}"
+    LOGGER.debug(msg)
+    ALIASES.pop(alias, None)
+
+
+def cached_alias(alias):
+    """Get (room_id, error) for a room alias, if it was resolved recently enough."""
+    if alias not in ALIASES:
+        return None
+    room_id, error, resolved = ALIASES[alias]
+    age = time.monotonic() - resolved
+    if age >= (conf.ALIAS_TTL if room_id else conf.ALIAS_NEGATIVE_TTL):
+        return None
+    ALIAS_LOOKUPS.inc(result="hit" if room_id else "negative")
+    ALIAS_AGE.observe(age)
+    return room_id, error
+
 
+async def resolve_room(room_id):
+    """Get the ID of a room, which might be given as an alias.
 
-async def join_room(room_id):
-    """Try to join the room."""
-    msg = f"Join room {room_id=}"
+    Return either the room ID, or an error JSON response.
+    """
+    if not room_id.startswith("#"):
+        return room_id
+    alias = room_id
+
+    cached = cached_alias(alias)
+    if cached is not None:
+        room_id, error = cached
+        return room_id or create_json_response(*error)
+
+    ALIAS_LOOKUPS.inc(result="miss")
+    msg = f"Resolve room {alias=}"
     LOGGER.debug(msg)
+    account = accounts.first_available()
+    resp = await call_homeserver(
+        account,
+        lambda: account.client.room_resolve_alias(alias),
+        RoomResolveAliasError,
+    )
+    if isinstance(resp, web.Response):
+        return resp
+    if isinstance(resp, RoomResolveAliasError):
+        error = (error_map(resp), resp.message)
+        if resp.status_code == "M_NOT_FOUND" and conf.ALIAS_NEGATIVE_TTL:
+            cache_alias(alias, None, error)
+        return create_json_response(*error)
+
+    previous = ALIASES.get(alias, (None,))[0]
+    if previous is not None and previous != resp.room_id:
+        ALIAS_CHANGES.inc()
+        msg = f"Room {alias=} moved from {previous} to {resp.room_id}"
+        LOGGER.info(msg)
+    if conf.ALIAS_TTL:
+        cache_alias(alias, resp.room_id)
+    return resp.room_id
+
+
+async def prime_joined_rooms(account):
+    """Fill the joined rooms cache of an account from the homeserver."""
+    resp = await account.client.joined_rooms()
+    if isinstance(resp, JoinedRoomsResponse):
+        now = time.monotonic()
+        for room_id in resp.rooms:
+            account.joined_rooms[room_id] = now
+        msg = f"Primed {len(resp.rooms)} joined rooms for {account.user_id}"
+        LOGGER.info(msg)
+    else:
+        msg = f"Can't prime joined rooms: {resp}"
+        LOGGER.warning(msg)
+
+
+async def login(account):
+    """Log an account in with a password, once for all the workers if there are many."""
+    if TOKEN_FILE is not None:
+        return await shared_login(account)
+    return await password_login(account)
+
+
+async def password_login(account, refresh_token=True):
+    """Log an account in with a password, and ask for a refresh token.
+
+    If the homeserver gives us one, the access token is renewed before it expires.
+    """
+    client = account.client
+    msg = f"Log in {client.user=} on {client.homeserver=}"
+    LOGGER.info(msg)
+    auth = {
+        "type": "m.login.password",
+        "identifier": {"type": "m.id.user", "user": client.user},
+        "password": account.password,
+        "refresh_token": refresh_token,
+    }
+    if client.device_id:
+        # don't create a new device on each login
+        auth["device_id"] = client.device_id
+    resp = await client.login_raw(auth)
+    if isinstance(resp, LoginResponse):
+        account.down_until = 0
+        schedule_refresh(account, await resp.transport_response.json())
+    else:
+        msg = f"Login failed: {resp}"
+        LOGGER.error(msg)
+        account.down()
+    return resp
+
 
-    for _ in range(10):
-        try:
-            resp = await CLIENT.join(room_id)
-            if isinstance(resp, JoinError):
+async def shared_login(account):
+    """Share a single login of an account between the workers, through the TOKEN_FILE.
+
+    The file is locked meanwhile. If it has a token which we didn't try yet, another
+    worker already logged in, so we use it. Otherwise, we log in and write our token.
+    Refresh tokens are not used, as renewing a token would break the other workers.
+    """
+    client = account.client
+    fd = await asyncio.get_event_loop().run_in_executor(None, lock_token_file)
+    try:
+        tokens = json.loads(os.read(fd, TOKEN_FILE_SIZE) or "{}")
+        shared = tokens.get(account.user_id, {})
+        if shared.get("access_token", client.access_token) != client.access_token:
+            msg = f"Using the access token of another worker for {account.user_id}"
+            LOGGER.info(msg)
+            client.user_id = shared["user_id"]
+            client.device_id = shared["device_id"]
+            client.access_token = shared["access_token"]
+            account.down_until = 0
+            return None
+        resp = await password_login(account, refresh_token=False)
+        if isinstance(resp, LoginResponse):
+            tokens[account.user_id] = {
+                "user_id": resp.user_id,
+                "device_id": resp.device_id,
+                "access_token": resp.access_token,
+            }
+            os.ftruncate(fd, 0)
+            os.pwrite(fd, json.dumps(tokens).encode(), 0)
+        return resp
+    finally:
+        fcntl.flock(fd, fcntl.LOCK_UN)
+        os.close(fd)
+
+
+def lock_token_file():
+    """Open the TOKEN_FILE, and wait until the other workers are done with it."""
+    fd = os.open(TOKEN_FILE, os.O_RDWR)
+    fcntl.flock(fd, fcntl.LOCK_EX)
+    return fd
+
+
+def schedule_refresh(account, data):
+    """Plan the renewal of the access token of an account, if it expires."""
+    if account.refresher is not None:
+        account.refresher.cancel()
+        account.refresher = None
+    account.refresh_token = data.get("refresh_token")
+    expires_in_ms = data.get("expires_in_ms")
+    if account.refresh_token and expires_in_ms:
+        delay = expires_in_ms / 1000 * REFRESH_MARGIN
+        msg = f"Access token of {account.user_id} will be refreshed in {delay:.0f}s"
+        LOGGER.info(msg)
+        account.refresher = asyncio.get_event_loop().call_later(
+            delay,
+            start_refresh,
+            account,
+        )
+
+
+def start_refresh(account):
+    """Launch the renewal of the access token of an account, and keep track of it."""
+    task = asyncio.ensure_future(refresh(account))
+    REFRESHES.add(task)
+    task.add_done_callback(REFRESHES.discard)
+
+
+async def refresh(account):
+    """Renew the access token of an account with its refresh token."""
+    msg = f"Refreshing access token of {account.user_id}"
+    LOGGER.info(msg)
+    try:
+        transport = await account.client.send(
+            "POST",
+            "/_matrix/client/v3/refresh",
+            json.dumps({"refresh_token": account.refresh_token}),
+            {"Content-Type": "application/json"},
+        )
+        data = await transport.json()
+    except (ClientError, asyncio.TimeoutError, ValueError) as e:
+        data = {"error": repr(e)}
+    else:
+        if transport.status == HTTPStatus.OK:
+            account.client.access_token = data["access_token"]
+            # without a new refresh token, the current one is still valid
+            data.setdefault("refresh_token", account.refresh_token)
+            schedule_refresh(account, data)
+            return
+    # The next request will fail with M_UNKNOWN_TOKEN, and log in again
+    msg = f"Can't refresh access token: {data}"
+    LOGGER.warning(msg)
+
+
+async def relogin(account, stale_token):
+    """Get a new access token, once for all the requests which saw stale_token fail."""
+    if account.client.access_token != stale_token:
+        # someone else already got a new one
+        return
+    if not account.password:
+        msg = f"Access token of {account.user_id} is not valid anymore, and no password"
+        LOGGER.error(msg)
+        account.down()
+        return
+    if account.login is None or account.login.done():
+        msg = f"Reconnecting {account.user_id}"
+        LOGGER.warning(msg)
+        account.login = asyncio.ensure_future(login(account))
+    await asyncio.shield(account.login)
+
+
+def transient(resp):
+    """Check if an error response means that the homeserver is failing."""
+    transport = resp.transport_response
+    return (
+        transport is not None and transport.status >= HTTPStatus.INTERNAL_SERVER_ERROR
+    )
+
+
+def homeserver_unavailable():
+    """Fail fast while the circuit breaker is open."""
+    retry_after = retry.BREAKER.retry_after()
+    return create_json_response(
+        HTTPStatus.SERVICE_UNAVAILABLE,
+        "Homeserver unavailable",
+        headers={"Retry-After": str(math.ceil(retry_after))},
+    )
+
+
+async def call_homeserver(account, call, error_type, bucket=None, room_id=None):
+    """Call the homeserver as an account, following the retry policy and the breaker.
+
+    Return either the nio response, which might be a definitive error of `error_type`,
+    or an error JSON response if we gave up.
+    """
+    if not retry.BREAKER.allow():
+        return homeserver_unavailable()
+    if bucket is None:
+        bucket = account.bucket
+
+    probe = retry.BREAKER.is_probe()
+    deadline = time.monotonic() + conf.RETRY_DEADLINE
+    try:
+        for attempt in range(conf.RETRY_ATTEMPTS):
+            if attempt:
+                metrics.HOMESERVER_RETRIES.inc()
+            token = account.client.access_token
+            try:
+                await ratelimit.acquire(room_id, bucket)
+                resp = await call()
+            except LocalProtocolError as e:
+                msg = f"Send error: {e}"
+                LOGGER.error(msg)
+                await relogin(account, token)
+            except (ClientConnectionError, asyncio.TimeoutError) as e:
+                msg = f"Homeserver error: {e!r}"
+                LOGGER.error(msg)
+                metrics.HOMESERVER_ERRORS.inc(errcode=type(e).__name__)
+                retry.BREAKER.failure()
+            else:
+                if not isinstance(resp, error_type):
+                    retry.BREAKER.success()
+                    bucket.succeeded()
+                    return resp
+                metrics.HOMESERVER_ERRORS.inc(errcode=resp.status_code or "unknown")
                 if resp.status_code == "M_UNKNOWN_TOKEN":
-                    LOGGER.warning("Reconnecting")
-                    if conf.MATRIX_PW:
-                        await CLIENT.login(conf.MATRIX_PW)
+                    await relogin(account, token)
+                elif ratelimit.limited(resp, bucket):
+                    if bucket is account.bucket and accounts.spare(account):
+                        # another account can take over
+                        return resp
+                elif transient(resp):
+                    msg = f"Homeserver error: {resp}"
+                    LOGGER.error(msg)
+                    retry.BREAKER.failure()
                 else:
-                    return create_json_response(error_map(resp), resp.message)
-            else:
-                return None
-        except LocalProtocolError as e:
-            msg = f"Send error: {e}"
-            LOGGER.error(msg)
-            LOGGER.warning("Reconnecting")
-            if conf.MATRIX_PW:
-                await CLIENT.login(conf.MATRIX_PW)
-        LOGGER.warning("Trying again")
+                    retry.BREAKER.success()
+                    return resp
+
+            delay = retry.backoff(attempt)
+            if time.monotonic() + delay > deadline:
+                break
+            # the probe keeps its slot while the breaker is half-open
+            if not retry.BREAKER.allow(probe):
+                return homeserver_unavailable()
+            probe = retry.BREAKER.is_probe()
+            msg = f"Trying again in {delay:.3f}s"
+            LOGGER.warning(msg)
+            await asyncio.sleep(delay)
+    finally:
+        if probe:
+            retry.BREAKER.release()
     return create_json_response(HTTPStatus.GATEWAY_TIMEOUT, "Homeserver not responding")
 
 
-async def send_room_message(room_id, content):
-    """Send a message to a room."""
+async def join_room(account, room_id, alias=None):
+    """Try to join the room with an account, unless it already did recently.
+
+    When the room was given by an alias, it is joined by this alias, st. the homeserver
+    knows which servers can let us join a room it doesn't know yet.
+    """
+    if is_joined(account, room_id):
+        msg = f"Already joined room {room_id=}"
+        LOGGER.debug(msg)
+        return None
+
+    msg = f"Join room {room_id=} {alias=} with {account.user_id}"
+    LOGGER.debug(msg)
+
+    with metrics.STAGE_SECONDS.time(stage="join"):
+        resp = await call_homeserver(
+            account,
+            lambda: account.client.join(alias or room_id),
+            JoinError,
+            account.joins,
+        )
+    if isinstance(resp, web.Response):
+        return resp
+    if isinstance(resp, JoinError):
+        return error_response(resp)
+    account.joined_rooms[room_id] = time.monotonic()
+    return None
+
+
+async def send_room_message(
+    account,
+    room_id,
+    content,
+    rejoin=True,
+    tx_id=None,
+    alias=None,
+):
+    """Send a message to a room, as an account.
+
+    All the attempts use the same transaction id, st. the homeserver can recognize a
+    retry of a message which it already got. On success, the event_id of the message
+    is in the response, as resp["event_id"].
+
+    With rejoin, the room came from the joined rooms cache, which might be stale: if the
+    homeserver says we are not in the room, it is joined again before a last try.
+    """
+    if tx_id is None:
+        tx_id = str(uuid4())
     msg = f"Sending room message in {room_id=}: {content=}"
     LOGGER.debug(msg)
 
-    for _ in range(10):
-        try:
-            resp = await CLIENT.room_send(
+    with metrics.STAGE_SECONDS.time(stage="send"):
+        resp = await call_homeserver(
+            account,
+            lambda: account.client.room_send(
                 room_id=room_id,
                 message_type="m.room.message",
                 content=content,
-            )
-            if isinstance(resp, RoomSendError):
-                if resp.status_code == "M_UNKNOWN_TOKEN":
-                    LOGGER.warning("Reconnecting")
-                    if conf.MATRIX_PW:
-                        await CLIENT.login(conf.MATRIX_PW)
-                else:
-                    return create_json_response(error_map(resp), resp.message)
-            else:
-                return create_json_response(HTTPStatus.OK, "OK")
-        except LocalProtocolError as e:
-            msg = f"Send error: {e}"
-            LOGGER.error(msg)
-            LOGGER.warning("Reconnecting")
-            if conf.MATRIX_PW:
-                await CLIENT.login(conf.MATRIX_PW)
-        LOGGER.warning("Trying again")
-    return create_json_response(HTTPStatus.GATEWAY_TIMEOUT, "Homeserver not responding")
+                tx_id=tx_id,
+            ),
+            RoomSendError,
+            room_id=room_id,
+        )
+    if isinstance(resp, web.Response):
+        return resp
+    if isinstance(resp, RoomSendError):
+        if rejoin and not_in_room(resp):
+            # our cache was stale: join again, and retry
+            forget_room(account, room_id)
+            join_resp = await join_room(account, room_id, alias)
+            if join_resp is not None:
+                return join_resp
+            return await send_room_message(account, room_id, content, False, tx_id)
+        return error_response(resp)
+    response = create_json_response(HTTPStatus.OK, "OK")
+    response["event_id"] = resp.event_id
+    return response
+
+
+async def deliver(room_id, content, tx_id=None):
+    """Join the room if needed, and send a message there.
+
+    The room can be given by its ID, or by an alias.
+    """
+    alias = room_id if room_id.startswith("#") else None
+    room_id = await resolve_room(room_id)
+    if isinstance(room_id, web.Response):
+        return room_id
+
+    resp = await deliver_to_room(room_id, content, tx_id, alias)
+    if alias and resp.status in {HTTPStatus.FORBIDDEN, HTTPStatus.NOT_FOUND}:
+        # this alias might now be for another room
+        forget_alias(alias)
+    return resp
+
+
+async def deliver_to_room(room_id, content, tx_id=None, alias=None):
+    """Join a room given by its ID if needed, and send a message there.
+
+    The message is sent by the account of this room, or another one if it is limited.
+    The alias which gave this room ID, if any, is used to join it.
+    """
+    while True:
+        account = accounts.pick(room_id)
+        resp = forbidden(room_id, account)
+        if resp is None:
+            resp = await deliver_as(account, room_id, content, tx_id, alias)
+            if conf.FORBIDDEN_TTL and resp.get("errcode") in FORBIDDEN_ERRCODES:
+                forbid_room(room_id, account, resp)
+            elif resp.status == HTTPStatus.OK:
+                FORBIDDEN_ROOMS.pop((room_id, account.user_id), None)
+        if (
+            resp.get("errcode") != "M_LIMIT_EXCEEDED"
+            or accounts.pick(room_id) is account
+        ):
+            return resp
+
+
+async def deliver_as(account, room_id, content, tx_id=None, alias=None):
+    """Join a room as an account if needed, and send a message there.
+
+    Updates of an alert already sent in this room by the same account are sent as edits.
+    """
+    # a room we just joined can't be stale in the cache
+    rejoin = is_joined(account, room_id)
+    # try to join room first -> non none response means error
+    resp = await join_room(account, room_id, alias)
+    if resp is not None:
+        return resp
+    if edits.FINGERPRINT not in content:
+        return await send_room_message(
+            account,
+            room_id,
+            content,
+            rejoin,
+            tx_id,
+            alias,
+        )
+
+    content = content.copy()
+    fingerprint = content.pop(edits.FINGERPRINT)
+    event_id = edits.get(room_id, fingerprint, account.user_id)
+    edit = edits.replace(content, event_id) if event_id else None
+    if edit is not None:
+        edits.EDITS.inc()
+        return await send_room_message(account, room_id, edit, rejoin, tx_id, alias)
+    resp = await send_room_message(account, room_id, content, rejoin, tx_id, alias)
+    if resp.status == HTTPStatus.OK:
+        edits.remember(room_id, fingerprint, resp["event_id"], account.user_id)
+    return resp
@@ -0,0 +1,233 @@
+#!/usr/bin/env python
+"""Benchmark matrix_webhook against a fake homeserver.
+
+Concurrent webhooks are sent for each formatter, and throughput, latency percentiles
+and memory usage of the bot are reported as JSON, to compare releases.
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import platform
+import socket
+import sys
+import time
+from hmac import HMAC
+from pathlib import Path
+
+from aiohttp import ClientError, ClientSession, web
+from fake_homeserver import FakeHomeserver
+
+KEY = "bench"
+TESTS = Path(__file__).parent
+
+parser = argparse.ArgumentParser(description=__doc__)
+parser.add_argument("-n", "--requests", type=int, default=2000, help="per scenario")
+parser.add_argument("-c", "--concurrency", type=int, default=50)
+parser.add_argument("-r", "--rooms", type=int, default=10, help="rooms to post to")
+parser.add_argument("--latency", type=float, default=0, help="homeserver latency, ms")
+parser.add_argument("--error-rate", type=float, default=0, help="homeserver errors")
+parser.add_argument("--rate-limit", type=float, default=0, help="homeserver limit")
+parser.add_argument(
+    "-s",
+    "--scenario",
+    action="append",
+    help="only run those scenarios. Default: all",
+)
+parser.add_argument("-o", "--output", help="write the JSON results to this file")
+parser.add_argument(
+    "bot_args",
+    nargs="*",
+    help="extra arguments for matrix_webhook, after a `--`",
+)
+
+
+def example(name):
+    """Read an example payload from the tests."""
+    return (TESTS / f"example_{name}.json").read_bytes().strip()
+
+
+def github_headers(body):
+    """Sign a github push."""
+    digest = HMAC(KEY.encode(), body, "sha256").hexdigest()
+    return {"X-GitHub-Event": "push", "X-Hub-Signature-256": f"sha256={digest}"}
+
+
+# name -> (query parameters, body, headers)
+SCENARIOS = {
+    "plain": (
+        {"key": KEY},
+        json.dumps({"body": "new contrib from toto: [44](http://radio.localhost)"}),
+        {},
+    ),
+    "github": ({"formatter": "github"}, example("github_push"), None),
+    "gitlab_gchat": (
+        {"formatter": "gitlab_gchat", "key": KEY},
+        example("gitlab_gchat"),
+        {},
+    ),
+    "gitlab_teams": (
+        {"formatter": "gitlab_teams", "key": KEY},
+        example("gitlab_teams"),
+        {},
+    ),
+    "grafana": ({"formatter": "grafana", "key": KEY}, example("grafana"), {}),
+    "grafana_9x": (
+        {"formatter": "grafana_9x"},
+        json.dumps({**json.loads(example("grafana_9x")), "key": KEY}),
+        {},
+    ),
+    "grn": ({"formatter": "grn", "key": KEY}, example("grn"), {}),
+}
+
+
+def free_port():
+    """Find a free TCP port."""
+    with socket.socket() as sock:
+        sock.bind(("localhost", 0))
+        return sock.getsockname()[1]
+
+
+def rss_kb(pid):
+    """Get the resident memory of a process, in kB, on Linux."""
+    try:
+        status = Path(f"/proc/{pid}/status").read_text()
+    except OSError:
+        return None
+    for line in status.splitlines():
+        if line.startswith("VmRSS:"):
+            return int(line.split()[1])
+    return None
+
+
+def cpu_seconds(pid):
+    """Get the CPU time used by a process, in seconds, on Linux."""
+    try:
+        stat = Path(f"/proc/{pid}/stat").read_text()
+    except OSError:
+        return None
+    # utime and stime, after the command name which might have spaces
+    utime, stime = stat.rsplit(")", 1)[1].split()[11:13]
+    return (int(utime) + int(stime)) / os.sysconf("SC_CLK_TCK")
+
+
+def percentile(values, fraction):
+    """Get a percentile of sorted values."""
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+async def wait_available(session, url, timeout=10):
+    """Wait until the bot answers."""
+    start = time.monotonic()
+    while time.monotonic() < start + timeout:
+        try:
+            async with session.get(f"{url}/health") as resp:
+                if resp.status == 200:
+                    return True
+        except ClientError:
+            pass
+        await asyncio.sleep(0.1)
+    return False
+
+
+async def scenario(session, url, name, args):
+    """Send concurrent webhooks, and measure them."""
+    params, body, headers = SCENARIOS[name]
+    if headers is None:
+        headers = github_headers(body)
+    latencies = []
+    statuses = {}
+    todo = iter(range(args.requests))
+
+    async def client():
+        for i in todo:
+            room = f"!bench{i % args.rooms}:localhost"
+            start = time.perf_counter()
+            async with session.post(
+                f"{url}/{room}",
+                params=params,
+                data=body,
+                headers=headers,
+            ) as resp:
+                await resp.read()
+            latencies.append(time.perf_counter() - start)
+            statuses[resp.status] = statuses.get(resp.status, 0) + 1
+
+    start = time.perf_counter()
+    await asyncio.gather(*(client() for _ in range(args.concurrency)))
+    duration = time.perf_counter() - start
+    latencies.sort()
+    return {
+        "scenario": name,
+        "requests": args.requests,
+        "concurrency": args.concurrency,
+        "duration_s": round(duration, 3),
+        "throughput_rps": round(args.requests / duration, 1),
+        "p50_ms": round(percentile(latencies, 0.5) * 1000, 3),
+        "p99_ms": round(percentile(latencies, 0.99) * 1000, 3),
+        "statuses": {str(k): v for k, v in sorted(statuses.items())},
+    }
+
+
+async def bench(args):
+    """Start the fake homeserver and the bot, and run the scenarios."""
+    homeserver = FakeHomeserver(args.latency, args.error_rate, args.rate_limit)
+    runner = web.AppRunner(homeserver.app(), access_log=None)
+    await runner.setup()
+    hs_port, bot_port = free_port(), free_port()
+    await web.TCPSite(runner, "localhost", hs_port).start()
+
+    bot = await asyncio.create_subprocess_exec(
+        sys.executable,
+        "-m",
+        "matrix_webhook",
+        *("--port", str(bot_port), "--api-key", KEY),
+        *("--matrix-url", f"http://localhost:{hs_port}"),
+        *("--matrix-id", "@bench:localhost", "--matrix-pw", "bench"),
+        *args.bot_args,
+        cwd=TESTS.parent,
+    )
+    url = f"http://localhost:{bot_port}"
+    results = []
+    try:
+        async with ClientSession() as session:
+            if not await wait_available(session, url):
+                sys.exit("matrix_webhook did not start")
+            idle_rss = rss_kb(bot.pid)
+            for name in args.scenario or SCENARIOS:
+                cpu = cpu_seconds(bot.pid)
+                result = await scenario(session, url, name, args)
+                if cpu is not None:
+                    cpu = cpu_seconds(bot.pid) - cpu
+                    result["cpu_ms_per_request"] = round(cpu * 1000 / args.requests, 3)
+                result["rss_kb"] = rss_kb(bot.pid)
+                print(json.dumps(result), file=sys.stderr)
+                results.append(result)
+    finally:
+        bot.terminate()
+        await bot.wait()
+        await runner.cleanup()
+
+    return {
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "bot_args": args.bot_args,
+        "homeserver": {
+            "latency_ms": args.latency,
+            "error_rate": args.error_rate,
+            "rate_limit": args.rate_limit,
+            "calls": homeserver.calls,
+        },
+        "idle_rss_kb": idle_rss,
+        "results": results,
+    }
+
+
+if __name__ == "__main__":
+    args = parser.parse_args()
+    report = json.dumps(asyncio.run(bench(args)), indent=2)
+    if args.output:
+        Path(args.output).write_text(report + "\n")
+    else:
+        print(report)
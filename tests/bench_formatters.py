@@ -0,0 +1,127 @@
+"""Benchmark the formatters, on the example payloads of the tests, scaled up.
+
+eg. the github push is repeated with more and more commits, and the grafana alert with
+more and more series, to check that formatters stay linear.
+Run from the root of the repository: `python -m tests.bench_formatters`
+"""
+
+import argparse
+import json
+import timeit
+from pathlib import Path
+
+from matrix_webhook import formatters
+
+TESTS = Path(__file__).parent
+HEADERS = {"X-GitHub-Event": "push", "X-Hub-Signature-256": "sha256=0"}
+
+parser = argparse.ArgumentParser(description=__doc__)
+parser.add_argument(
+    "-s",
+    "--scale",
+    type=int,
+    action="append",
+    help="how many times payloads are repeated. Default: 1, 100, 1000 and 10000",
+)
+parser.add_argument(
+    "-f",
+    "--formatter",
+    action="append",
+    help="only run those formatters. Default: all",
+)
+parser.add_argument("-o", "--output", help="write the results to this JSON file")
+
+
+def example(name):
+    """Read an example payload from the tests."""
+    return json.loads((TESTS / f"example_{name}.json").read_text())
+
+
+def github(scale):
+    """Push more commits."""
+    data = example("github_push")
+    data["commits"] = data["commits"] * scale
+    return data
+
+
+def gitlab_gchat(scale):
+    """Send more lines."""
+    data = example("gitlab_gchat")
+    return {"body": "\n".join([data["text"]] * scale)}
+
+
+def gitlab_teams(scale):
+    """Send more sections."""
+    data = example("gitlab_teams")
+    data["sections"] = data["sections"] * scale
+    return data
+
+
+def grafana(scale):
+    """Alert on more series."""
+    data = example("grafana")
+    data["evalMatches"] = data["evalMatches"] * scale
+    return data
+
+
+def grafana_9x(scale):
+    """Send a longer message."""
+    data = example("grafana_9x")
+    data["message"] = data["message"] * scale
+    return data
+
+
+def grn(scale):
+    """Release a package with a longer title."""
+    data = example("grn")
+    data["title"] = data["title"] * scale
+    return data
+
+
+# formatter name -> function building a payload scaled up
+PAYLOADS = {
+    "github": github,
+    "gitlab_gchat": gitlab_gchat,
+    "gitlab_teams": gitlab_teams,
+    "grafana": grafana,
+    "grafana_9x": grafana_9x,
+    "grn": grn,
+}
+
+
+def measure(name, scale):
+    """Get the payload size in kB and the mean time of a formatter call in µs."""
+    formatter = formatters.FORMATTERS[name]
+    data = PAYLOADS[name](scale)
+
+    def call():
+        # formatters only set a few keys, so a shallow copy is enough
+        return formatter(dict(data), HEADERS)
+
+    number, _ = timeit.Timer(call).autorange()
+    duration = timeit.timeit(call, number=number) / number * 1e6
+    return len(json.dumps(data)) // 1024, duration
+
+
+def main():
+    """Run all the measures, and print them as a table."""
+    args = parser.parse_args()
+    scales = args.scale or [1, 100, 1000, 10000]
+    results = []
+    print(f"{'formatter':<14}{'scale':>7}{'kB':>8}{'time':>14}{'per item':>12}")
+    for name in args.formatter or PAYLOADS:
+        for scale in scales:
+            size, duration = measure(name, scale)
+            results.append(
+                {"formatter": name, "scale": scale, "kB": size, "us": duration},
+            )
+            print(
+                f"{name:<14}{scale:>7}{size:>8}"
+                f"{duration:>12.1f}µs{duration / scale:>10.2f}µs",
+            )
+    if args.output:
+        Path(args.output).write_text(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,69 @@
+"""Benchmark JSON parsing and serialization, with the stdlib and matrix_webhook.codec.
+
+Example payloads are repeated to reach realistic sizes for big webhooks.
+Run from the root of the repository: `python -m tests.bench_json`
+"""
+
+import argparse
+import json
+import timeit
+from pathlib import Path
+
+from matrix_webhook import codec
+
+TESTS = Path(__file__).parent
+
+parser = argparse.ArgumentParser(description=__doc__)
+parser.add_argument(
+    "-s",
+    "--size",
+    type=int,
+    action="append",
+    help="payload sizes, in kB. Default: 1, 100 and 500",
+)
+parser.add_argument("-n", "--number", type=int, default=0, help="runs per measure")
+
+
+def payload(name, size):
+    """Repeat an example payload in a list of about `size` bytes."""
+    data = json.loads((TESTS / f"example_{name}.json").read_text())
+    one = len(json.dumps(data))
+    return json.dumps({"items": [data] * max(1, size // one)}).encode()
+
+
+def measure(function, arg, number):
+    """Get the mean time of a call, in µs."""
+    if not number:
+        number, _ = timeit.Timer(lambda: function(arg)).autorange()
+    return timeit.timeit(lambda: function(arg), number=number) / number * 1e6
+
+
+def main():
+    """Run all the measures, and print them as a table."""
+    args = parser.parse_args()
+    sizes = args.size or [1, 100, 500]
+    print(f"codec backend: {codec.BACKEND}")
+    print(
+        f"{'payload':<16}{'kB':>6}{'json.loads':>14}{'codec.loads':>14}{'speedup':>9}",
+    )
+    for path in sorted(TESTS.glob("example_*.json")):
+        name = path.stem[len("example_") :]
+        for size in sizes:
+            data = payload(name, size * 1024)
+            stdlib = measure(lambda b: json.loads(b.decode()), data, args.number)
+            fast = measure(codec.loads, data, args.number)
+            print(
+                f"{name:<16}{len(data) // 1024:>6}"
+                f"{stdlib:>12.1f}µs{fast:>12.1f}µs{stdlib / fast:>8.1f}x",
+            )
+    data = json.loads(payload("github_push", 100 * 1024))
+    stdlib = measure(lambda d: json.dumps(d).encode(), data, args.number)
+    fast = measure(codec.dumps, data, args.number)
+    print(
+        f"{'dumps github':<16}{100:>6}{stdlib:>12.1f}µs{fast:>12.1f}µs"
+        f"{stdlib / fast:>8.1f}x",
+    )
+
+
+if __name__ == "__main__":
+    main()
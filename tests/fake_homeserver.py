@@ -0,0 +1,177 @@
+#!/usr/bin/env python
+"""Lightweight stand-in for a matrix homeserver, for benchmarks and tests.
+
+It only implements what matrix_webhook needs: login, token refresh, join and send, with
+configurable latency, errors and rate limits.
+"""
+
+import argparse
+import asyncio
+import itertools
+import random
+import time
+
+from aiohttp import web
+
+parser = argparse.ArgumentParser(description=__doc__)
+parser.add_argument("--host", default="localhost", help="host to listen to")
+parser.add_argument("--port", type=int, default=8008, help="port to listen to")
+parser.add_argument(
+    "--latency",
+    type=float,
+    default=0,
+    help="milliseconds to wait before answering",
+)
+parser.add_argument(
+    "--error-rate",
+    type=float,
+    default=0,
+    help="fraction of sends answered with a 502",
+)
+parser.add_argument(
+    "--rate-limit",
+    type=float,
+    default=0,
+    help="messages per second allowed before M_LIMIT_EXCEEDED. 0 for unlimited",
+)
+parser.add_argument(
+    "--burst",
+    type=int,
+    default=10,
+    help="messages allowed at once before rate limiting",
+)
+
+
+class FakeHomeserver:
+    """State of the fake homeserver."""
+
+    def __init__(self, latency=0, error_rate=0, rate_limit=0, burst=10):
+        """Configure the behaviour of the fake homeserver."""
+        self.latency = latency / 1000
+        self.error_rate = error_rate
+        self.rate_limit = rate_limit
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+        self.counter = itertools.count()
+        self.calls = {
+            "login": 0,
+            "refresh": 0,
+            "join": 0,
+            "send": 0,
+            "limited": 0,
+            "errors": 0,
+        }
+        self.messages = []  # (room, body) of the messages accepted
+        self.expires_ms = 0  # lifetime of access tokens given with a refresh token
+        self.forbidden = set()  # rooms where sends are answered with M_FORBIDDEN
+
+    async def wait(self):
+        """Simulate the latency of the homeserver."""
+        if self.latency:
+            await asyncio.sleep(self.latency)
+
+    def limited(self):
+        """Get the retry_after_ms if this request is rate limited, or 0."""
+        if not self.rate_limit:
+            return 0
+        now = time.monotonic()
+        self.tokens = min(
+            self.burst,
+            self.tokens + (now - self.updated) * self.rate_limit,
+        )
+        self.updated = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0
+        return int((1 - self.tokens) / self.rate_limit * 1000) + 1
+
+    async def login(self, request):
+        """Log in anyone."""
+        self.calls["login"] += 1
+        await self.wait()
+        data = await request.json()
+        resp = {
+            "user_id": data["identifier"]["user"],
+            "device_id": data.get("device_id", "BENCH"),
+            "access_token": f"token{next(self.counter)}",
+        }
+        if data.get("refresh_token") and self.expires_ms:
+            resp["refresh_token"] = "refresh"
+            resp["expires_in_ms"] = self.expires_ms
+        return web.json_response(resp)
+
+    async def refresh(self, request):
+        """Renew an access token, but keep the refresh token, as the spec allows."""
+        self.calls["refresh"] += 1
+        await self.wait()
+        await request.read()
+        if self.error_rate and random.random() < self.error_rate:
+            self.calls["errors"] += 1
+            # as a reverse proxy would answer
+            return web.Response(text="<h1>Bad Gateway</h1>", status=502)
+        return web.json_response(
+            {
+                "access_token": f"token{next(self.counter)}",
+                "expires_in_ms": self.expires_ms,
+            },
+        )
+
+    async def join(self, request):
+        """Join any room."""
+        self.calls["join"] += 1
+        await self.wait()
+        return web.json_response({"room_id": request.match_info["room"]})
+
+    async def send(self, request):
+        """Accept messages, unless there is an error or a rate limit."""
+        self.calls["send"] += 1
+        await self.wait()
+        content = await request.json()
+        retry_after_ms = self.limited()
+        if retry_after_ms:
+            self.calls["limited"] += 1
+            return web.json_response(
+                {
+                    "errcode": "M_LIMIT_EXCEEDED",
+                    "error": "Too Many Requests",
+                    "retry_after_ms": retry_after_ms,
+                },
+                status=429,
+            )
+        if self.error_rate and random.random() < self.error_rate:
+            self.calls["errors"] += 1
+            return web.json_response(
+                {"errcode": "M_UNKNOWN", "error": "Bad Gateway"},
+                status=502,
+            )
+        if request.match_info["room"] in self.forbidden:
+            return web.json_response(
+                {"errcode": "M_FORBIDDEN", "error": "You are not allowed to post"},
+                status=403,
+            )
+        self.messages.append((request.match_info["room"], content.get("body")))
+        return web.json_response({"event_id": f"$event{next(self.counter)}"})
+
+    def app(self):
+        """Get the aiohttp application."""
+        app = web.Application()
+        app.router.add_post("/_matrix/client/{version}/login", self.login)
+        app.router.add_post("/_matrix/client/{version}/refresh", self.refresh)
+        app.router.add_post("/_matrix/client/{version}/join/{room}", self.join)
+        app.router.add_put(
+            "/_matrix/client/{version}/rooms/{room}/send/{type}/{txn}",
+            self.send,
+        )
+        return app
+
+
+if __name__ == "__main__":
+    args = parser.parse_args()
+    homeserver = FakeHomeserver(
+        args.latency,
+        args.error_rate,
+        args.rate_limit,
+        args.burst,
+    )
+    web.run_app(homeserver.app(), host=args.host, port=args.port)
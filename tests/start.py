@@ -18,6 +18,9 @@ KEY, MATRIX_URL, MATRIX_ID, MATRIX_PW = (
     environ[v] for v in ["API_KEY", "MATRIX_URL", "MATRIX_ID", "MATRIX_PW"]
 )
 FULL_ID = f"@{MATRIX_ID}:{MATRIX_URL.split('/')[2]}"
+# another bot account, for tests/test_accounts.py
+MATRIX_ID_2 = f"{MATRIX_ID}2"
+FULL_ID_2 = f"@{MATRIX_ID_2}:{MATRIX_URL.split('/')[2]}"
 LOGGER = logging.getLogger("matrix-webhook.tests.start")
 
 parser = argparse.ArgumentParser(description=__doc__)
@@ -92,10 +95,11 @@ def run_and_test():
     with Path("/srv/homeserver.yaml").open() as f:
         secret = yaml.safe_load(f.read()).get("registration_shared_secret", None)
     request_registration(MATRIX_ID, MATRIX_PW, MATRIX_URL, secret, admin=True)
+    request_registration(MATRIX_ID_2, MATRIX_PW, MATRIX_URL, secret, admin=True)
 
     # Start the bot, and wait for it
     LOGGER.info("Spawning the bot")
-    bot = Popen(["coverage", "run", "-m", "matrix_webhook", "-vvvvv"])
+    bot = Popen(["coverage", "run", "-m", "matrix_webhook", "-vvvvv", "--edit-alerts"])
     if not wait_available(BOT_URL, "status"):
         return False
 
@@ -0,0 +1,73 @@
+"""Test module for a pool of bot accounts."""
+
+import asyncio
+import json
+import tempfile
+import unittest
+
+import httpx
+import nio
+
+from .start import (
+    FULL_ID,
+    FULL_ID_2,
+    KEY,
+    MATRIX_ID,
+    MATRIX_ID_2,
+    MATRIX_PW,
+    MATRIX_URL,
+    wait_available,
+)
+
+POOL_URL = "http://localhost:4786"
+
+
+class AccountsTest(unittest.IsolatedAsyncioTestCase):
+    """Bot accounts test class."""
+
+    async def test_accounts(self):
+        """Post twice to public rooms with 2 accounts, and check who posted where."""
+        client = nio.AsyncClient(MATRIX_URL, MATRIX_ID)
+
+        await client.login(MATRIX_PW)
+        rooms = [
+            (await client.room_create(preset=nio.RoomPreset.public_chat)).room_id
+            for _ in range(16)
+        ]
+
+        with tempfile.NamedTemporaryFile("w", suffix=".json") as accounts:
+            json.dump([{"user_id": MATRIX_ID_2, "password": MATRIX_PW}], accounts)
+            accounts.flush()
+            bot = await asyncio.create_subprocess_exec(
+                "python",
+                "-m",
+                "matrix_webhook",
+                "--port=4786",
+                f"--accounts={accounts.name}",
+            )
+            try:
+                self.assertTrue(wait_available(POOL_URL, "status"))
+                for room_id in rooms * 2:
+                    self.assertEqual(
+                        httpx.post(
+                            f"{POOL_URL}/{room_id}",
+                            params={"key": KEY},
+                            json={"body": "Hi"},
+                        ).json(),
+                        {"status": 200, "ret": "OK"},
+                    )
+            finally:
+                bot.terminate()
+                await bot.wait()
+
+        sync = await client.sync()
+        senders = set()
+        for room_id in rooms:
+            messages = await client.room_messages(room_id, sync.next_batch)
+            # rooms stick to the same account
+            self.assertEqual(messages.chunk[0].sender, messages.chunk[1].sender)
+            senders.add(messages.chunk[0].sender)
+        await client.close()
+
+        # rooms are shared by both accounts
+        self.assertEqual(senders, {FULL_ID, FULL_ID_2})
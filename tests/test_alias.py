@@ -0,0 +1,57 @@
+"""Test module for rooms given by an alias."""
+
+import unittest
+
+import httpx
+import nio
+
+from .start import BOT_URL, FULL_ID, KEY, MATRIX_ID, MATRIX_PW, MATRIX_URL
+
+SERVER_NAME = FULL_ID.split(":", 1)[1]
+
+
+class AliasTest(unittest.IsolatedAsyncioTestCase):
+    """Room alias test class."""
+
+    async def test_alias(self):
+        """Send messages to a room alias, and check that they get in the room."""
+        client = nio.AsyncClient(MATRIX_URL, MATRIX_ID)
+
+        await client.login(MATRIX_PW)
+        room = await client.room_create(alias="webhook-alias")
+
+        for body in ["First", "Second"]:
+            self.assertEqual(
+                httpx.post(
+                    BOT_URL,
+                    json={
+                        "body": body,
+                        "key": KEY,
+                        "room_id": f"#webhook-alias:{SERVER_NAME}",
+                    },
+                ).json(),
+                {"status": 200, "ret": "OK"},
+            )
+
+        sync = await client.sync()
+        messages = await client.room_messages(room.room_id, sync.next_batch)
+        await client.close()
+
+        bodies = [
+            message.body
+            for message in messages.chunk
+            if isinstance(message, nio.RoomMessageText)
+        ]
+        self.assertEqual(bodies, ["Second", "First"])
+
+    def test_unknown_alias(self):
+        """Send a message to an unknown room alias."""
+        alias = f"#webhook-unknown:{SERVER_NAME}"
+        for _ in range(2):
+            self.assertEqual(
+                httpx.post(
+                    BOT_URL,
+                    json={"body": "Hi", "key": KEY, "room_id": alias},
+                ).json()["status"],
+                404,
+            )
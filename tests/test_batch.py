@@ -0,0 +1,62 @@
+"""Test module for batches of messages."""
+
+import json
+import unittest
+
+import httpx
+import nio
+
+from .start import BOT_URL, FULL_ID, KEY, MATRIX_ID, MATRIX_PW, MATRIX_URL
+
+
+class BatchTest(unittest.IsolatedAsyncioTestCase):
+    """Batch test class."""
+
+    async def test_batch(self):
+        """Send a batch of messages to two rooms, and check the results."""
+        client = nio.AsyncClient(MATRIX_URL, MATRIX_ID)
+
+        await client.login(MATRIX_PW)
+        room_a = await client.room_create()
+        room_b = await client.room_create()
+
+        batch = [
+            {"body": "first", "room_id": room_a.room_id},
+            {"body": "other", "room_id": room_b.room_id},
+            {"room_id": room_a.room_id},
+            {"body": "second", "room_id": room_a.room_id},
+        ]
+        self.assertEqual(
+            httpx.post(BOT_URL, params={"key": KEY}, json=batch).json(),
+            {
+                "status": 207,
+                "ret": [
+                    {"status": 200, "ret": "OK"},
+                    {"status": 200, "ret": "OK"},
+                    {"status": 400, "ret": "Missing body"},
+                    {"status": 200, "ret": "OK"},
+                ],
+            },
+        )
+
+        sync = await client.sync()
+        messages = await client.room_messages(room_a.room_id, sync.next_batch)
+        await client.close()
+
+        # room_messages are the most recent first
+        self.assertEqual(
+            [(m.sender, m.body) for m in messages.chunk[:2]],
+            [(FULL_ID, "second"), (FULL_ID, "first")],
+        )
+
+    def test_ndjson_batch(self):
+        """Send a batch as newline delimited JSON, with a wrong key."""
+        batch = [{"body": "first", "key": KEY}, {"body": "second", "key": "wrong"}]
+        self.assertEqual(
+            httpx.post(
+                f"{BOT_URL}/wrong_room",
+                content="\n".join(json.dumps(item) for item in batch),
+                headers={"Content-Type": "application/x-ndjson"},
+            ).json(),
+            {"status": 401, "ret": "Invalid API key"},
+        )
@@ -0,0 +1,73 @@
+"""Test module for the circuit breaker probe."""
+
+import asyncio
+import unittest
+
+from nio.exceptions import LocalProtocolError
+from nio.responses import RoomSendError
+
+from matrix_webhook import accounts, retry, utils
+
+OK = object()
+
+
+class BreakerTest(unittest.IsolatedAsyncioTestCase):
+    """Circuit breaker test class."""
+
+    def setUp(self):
+        """Open a breaker which is half-open right away."""
+        self.breaker = retry.BREAKER
+        retry.BREAKER = retry.CircuitBreaker(1, 0)
+        retry.BREAKER.failure()
+        self.account = accounts.Account("@breaker:localhost", token="token")
+        self.account.client.access_token = "token"
+
+    def tearDown(self):
+        """Restore the real breaker."""
+        retry.BREAKER = self.breaker
+
+    async def probe(self, *answers):
+        """Send a probe which gets each answer in turn, and return its response."""
+        answers = iter(answers)
+
+        async def call():
+            answer = next(answers)
+            if isinstance(answer, Exception):
+                raise answer
+            if callable(answer):
+                return await answer()
+            return answer
+
+        return await utils.call_homeserver(self.account, call, RoomSendError)
+
+    async def test_unknown_token(self):
+        """The probe gets M_UNKNOWN_TOKEN, and retries with a new token."""
+
+        async def unknown_token():
+            self.account.client.access_token = "new token"
+            return RoomSendError("Unknown token", "M_UNKNOWN_TOKEN")
+
+        self.assertIs(await self.probe(unknown_token, OK), OK)
+        self.assertEqual(retry.BREAKER.state, retry.CLOSED)
+
+    async def test_local_protocol_error(self):
+        """The probe fails before reaching the homeserver, and retries."""
+        self.assertIs(await self.probe(LocalProtocolError("Not logged in"), OK), OK)
+        self.assertEqual(retry.BREAKER.state, retry.CLOSED)
+
+    async def test_rate_limited(self):
+        """The probe is rate limited, and retries, or lets another account do it."""
+        limited = RoomSendError("Too many requests", "M_LIMIT_EXCEEDED", 10)
+        self.assertIn(await self.probe(limited, OK), [OK, limited])
+        self.assertTrue(retry.BREAKER.allow())
+
+    async def test_cancelled(self):
+        """The probe is cancelled, and another request can probe."""
+        probe = asyncio.ensure_future(self.probe(lambda: asyncio.sleep(10)))
+        await asyncio.sleep(0.1)
+        self.assertFalse(retry.BREAKER.allow())
+        probe.cancel()
+        with self.assertRaises(asyncio.CancelledError):
+            await probe
+        self.assertEqual(retry.BREAKER.state, retry.HALF_OPEN)
+        self.assertTrue(retry.BREAKER.allow())
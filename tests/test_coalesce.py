@@ -0,0 +1,56 @@
+"""Test module for messages coalesced in a digest."""
+
+import asyncio
+import unittest
+
+import httpx
+import nio
+
+from .start import BOT_URL, FULL_ID, KEY, MATRIX_ID, MATRIX_PW, MATRIX_URL
+
+
+class CoalesceTest(unittest.IsolatedAsyncioTestCase):
+    """Coalesce test class."""
+
+    async def test_coalesce(self):
+        """Send a few messages in a coalescing window, and check the digest."""
+        client = nio.AsyncClient(MATRIX_URL, MATRIX_ID)
+
+        await client.login(MATRIX_PW)
+        room = await client.room_create()
+
+        # the last one is grouped with "down", but must not be lost
+        for body in ["down", "up", "down", "down\ndisk full"]:
+            self.assertEqual(
+                httpx.post(
+                    f"{BOT_URL}/{room.room_id}",
+                    params={"key": KEY, "coalesce": 1},
+                    json={"body": body},
+                ).json(),
+                {"status": 202, "ret": "Coalesced"},
+            )
+        await asyncio.sleep(2)
+
+        sync = await client.sync()
+        messages = await client.room_messages(room.room_id, sync.next_batch)
+        await client.close()
+
+        message = messages.chunk[0]
+        self.assertEqual(message.sender, FULL_ID)
+        self.assertEqual(
+            message.body,
+            "**4 notifications**\n\n### down\n\ndown\n\n*(2 times)*"
+            "\n\ndown\ndisk full\n\n### up\n\nup",
+        )
+
+    async def test_invalid_window(self):
+        """Refuse windows which are not finite, or too long."""
+        for window in ["inf", "nan", "1e9", "soon"]:
+            self.assertEqual(
+                httpx.post(
+                    f"{BOT_URL}/!room:localhost",
+                    params={"key": KEY, "coalesce": window},
+                    json={"body": "down"},
+                ).json(),
+                {"status": 400, "ret": "Invalid coalesce window"},
+            )
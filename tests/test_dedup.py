@@ -0,0 +1,41 @@
+"""Test module for redelivered webhooks."""
+
+import unittest
+
+import httpx
+import nio
+
+from .start import BOT_URL, KEY, MATRIX_ID, MATRIX_PW, MATRIX_URL
+
+
+class DedupTest(unittest.IsolatedAsyncioTestCase):
+    """Deduplication test class."""
+
+    async def test_redelivery(self):
+        """Send the same delivery twice, and check that it is posted once."""
+        client = nio.AsyncClient(MATRIX_URL, MATRIX_ID)
+
+        await client.login(MATRIX_PW)
+        room = await client.room_create()
+
+        for _ in range(2):
+            self.assertEqual(
+                httpx.post(
+                    f"{BOT_URL}/{room.room_id}",
+                    params={"key": KEY},
+                    headers={"X-Gitlab-Event-UUID": "13792a34-cac6-4fda-95a8"},
+                    json={"body": "Redelivered"},
+                ).json(),
+                {"status": 200, "ret": "OK"},
+            )
+
+        sync = await client.sync()
+        messages = await client.room_messages(room.room_id, sync.next_batch)
+        await client.close()
+
+        bodies = [
+            message.body
+            for message in messages.chunk
+            if isinstance(message, nio.RoomMessageText)
+        ]
+        self.assertEqual(bodies, ["Redelivered"])
@@ -0,0 +1,243 @@
+"""Test module for asynchronous delivery, against a fake homeserver."""
+
+import asyncio
+import sqlite3
+import tempfile
+import time
+import unittest
+from pathlib import Path
+
+import httpx
+from aiohttp import web
+
+from .fake_homeserver import FakeHomeserver
+
+KEY = "fake"
+BOT_URL = "http://localhost:4787"
+HOMESERVER_PORT = 4788
+
+
+def outbox_rows(path, table="outbox"):
+    """Read the (room_id, body) of the messages in a table of an outbox."""
+    query = f"SELECT room_id, json_extract(content, '$.body') FROM {table} ORDER BY id"
+    db = sqlite3.connect(path)
+    try:
+        return db.execute(query).fetchall()
+    finally:
+        db.close()
+
+
+class DeliveryTest(unittest.IsolatedAsyncioTestCase):
+    """Asynchronous delivery test class."""
+
+    async def asyncSetUp(self):
+        """Start a fake homeserver, which can fail or rate limit on demand."""
+        self.homeserver = FakeHomeserver()
+        self.runner = web.AppRunner(self.homeserver.app(), access_log=None)
+        await self.runner.setup()
+        await web.TCPSite(self.runner, "localhost", HOMESERVER_PORT).start()
+        self.client = httpx.AsyncClient(base_url=BOT_URL, params={"key": KEY})
+
+    async def asyncTearDown(self):
+        """Stop the fake homeserver."""
+        await self.client.aclose()
+        await self.runner.cleanup()
+
+    async def start_bot(self, *args):
+        """Start a bot using the fake homeserver, and wait for it."""
+        bot = await asyncio.create_subprocess_exec(
+            "python",
+            "-m",
+            "matrix_webhook",
+            "--port=4787",
+            f"--api-key={KEY}",
+            f"--matrix-url=http://localhost:{HOMESERVER_PORT}",
+            "--matrix-id=@fake:localhost",
+            "--matrix-pw=fake",
+            *args,
+        )
+        if not await self.available():
+            bot.terminate()
+            await bot.wait()
+            self.fail("matrix_webhook did not start")
+        return bot
+
+    async def available(self, timeout=10):
+        """Wait until the bot answers."""
+        start = time.monotonic()
+        while time.monotonic() < start + timeout:
+            try:
+                if (await self.client.get("/health")).status_code == 200:
+                    return True
+            except httpx.TransportError:
+                pass
+            await asyncio.sleep(0.1)
+        return False
+
+    async def stop_bot(self, bot):
+        """Stop a bot, and wait for it to drain its queues."""
+        bot.terminate()
+        await bot.wait()
+
+    async def delivered(self, count, timeout=10):
+        """Wait until the homeserver got some messages, and return them."""
+        start = time.monotonic()
+        while len(self.homeserver.messages) < count:
+            if time.monotonic() > start + timeout:
+                break
+            await asyncio.sleep(0.1)
+        return self.homeserver.messages
+
+    async def post(self, room_id, body):
+        """Send a webhook to the bot, and return its answer."""
+        return (await self.client.post(f"/{room_id}", json={"body": body})).json()
+
+    async def test_async_delivery(self):
+        """Messages are accepted right away, and delivered in order in each room."""
+        bot = await self.start_bot("--async-delivery")
+        try:
+            # slow enough for messages to wait in the queues
+            self.homeserver.latency = 0.02
+            sent = [(f"!room{i % 3}:localhost", f"message {i}") for i in range(30)]
+            for room_id, body in sent:
+                self.assertEqual(
+                    await self.post(room_id, body),
+                    {"status": 202, "ret": "Accepted"},
+                )
+            messages = await self.delivered(len(sent))
+        finally:
+            await self.stop_bot(bot)
+
+        self.assertEqual(sorted(messages), sorted(sent))
+        for room in range(3):
+            room_id = f"!room{room}:localhost"
+            self.assertEqual(
+                [message for message in messages if message[0] == room_id],
+                [message for message in sent if message[0] == room_id],
+            )
+
+    async def test_outbox_replay(self):
+        """Messages accepted during an outage are kept, and delivered after a restart."""
+        self.homeserver.error_rate = 1
+        with tempfile.TemporaryDirectory() as tmp:
+            outbox = str(Path(tmp) / "outbox.sqlite")
+            options = [
+                f"--outbox={outbox}",
+                "--retry-deadline=0.2",
+                "--drain-timeout=1",
+            ]
+            bot = await self.start_bot(*options)
+            try:
+                # in order in a room
+                ordered = [("!ordered:localhost", f"message {i}") for i in range(10)]
+                for room_id, body in ordered:
+                    self.assertEqual(
+                        await self.post(room_id, body),
+                        {"status": 202, "ret": "Accepted"},
+                    )
+                # at once in another, to be stored in the same commits
+                burst = [("!burst:localhost", f"message {i}") for i in range(20)]
+                answers = await asyncio.gather(
+                    *(self.post(room_id, body) for room_id, body in burst),
+                )
+                self.assertEqual(answers, [{"status": 202, "ret": "Accepted"}] * 20)
+            finally:
+                await self.stop_bot(bot)
+
+            self.assertEqual(self.homeserver.messages, [])
+            self.assertEqual(sorted(outbox_rows(outbox)), sorted(ordered + burst))
+
+            self.homeserver.error_rate = 0
+            bot = await self.start_bot(*options)
+            try:
+                messages = await self.delivered(len(ordered + burst))
+            finally:
+                await self.stop_bot(bot)
+
+            # delivered messages are removed from the outbox
+            self.assertEqual(outbox_rows(outbox), [])
+
+        self.assertEqual(sorted(messages), sorted(ordered + burst))
+        self.assertEqual([m for m in messages if m[0] == "!ordered:localhost"], ordered)
+
+    async def test_dead_letters(self):
+        """Messages are given up after --delivery-attempts, into the dead letters."""
+        self.homeserver.error_rate = 1
+        with tempfile.TemporaryDirectory() as tmp:
+            outbox = str(Path(tmp) / "outbox.sqlite")
+            bot = await self.start_bot(
+                f"--outbox={outbox}",
+                "--retry-deadline=0.2",
+                "--delivery-attempts=2",
+                "--breaker-threshold=1000",
+            )
+            try:
+                self.assertEqual(
+                    await self.post("!down:localhost", "Hi"),
+                    {"status": 202, "ret": "Accepted"},
+                )
+                metrics = ""
+                start = time.monotonic()
+                while 'reason="attempts"' not in metrics:
+                    self.assertLess(time.monotonic(), start + 10)
+                    await asyncio.sleep(0.1)
+                    metrics = (await self.client.get("/metrics")).text
+            finally:
+                await self.stop_bot(bot)
+
+            self.assertEqual(outbox_rows(outbox), [])
+            self.assertEqual(
+                outbox_rows(outbox, "dead_letters"),
+                [("!down:localhost", "Hi")],
+            )
+
+    async def test_rate_limit(self):
+        """After a M_LIMIT_EXCEEDED, messages are paced to what the homeserver allows."""
+        self.homeserver.rate_limit = 10
+        self.homeserver.burst = self.homeserver.tokens = 2
+        bot = await self.start_bot()
+        try:
+            # the first burst finds the limit, the second one should follow it
+            for burst in range(2):
+                limited = self.homeserver.calls["limited"]
+                answers = await asyncio.gather(
+                    *(
+                        self.post("!limited:localhost", f"{burst} {i}")
+                        for i in range(30)
+                    ),
+                )
+                self.assertEqual(answers, [{"status": 200, "ret": "OK"}] * 30)
+        finally:
+            await self.stop_bot(bot)
+
+        self.assertGreater(limited, 0)
+        self.assertLessEqual(self.homeserver.calls["limited"] - limited, 3)
+        self.assertEqual(len(self.homeserver.messages), 60)
+
+    async def test_joined_rooms(self):
+        """Rooms are joined once, and joined again only when the cache was stale."""
+        bot = await self.start_bot()
+        try:
+            for body in ["first", "second"]:
+                self.assertEqual(
+                    await self.post("!room:localhost", body),
+                    {"status": 200, "ret": "OK"},
+                )
+            self.assertEqual(self.homeserver.calls["join"], 1)
+
+            # a real M_FORBIDDEN right after a join is not worth another one
+            self.homeserver.forbidden.add("!banned:localhost")
+            forbidden = {"status": 403, "ret": "You are not allowed to post"}
+            answer = await self.post("!banned:localhost", "Hi")
+            self.assertEqual(answer, forbidden)
+            self.assertEqual(self.homeserver.calls["join"], 2)
+            self.assertEqual(self.homeserver.calls["send"], 3)
+
+            # but it is for a room joined earlier, where the bot might have been kicked
+            self.homeserver.forbidden.add("!room:localhost")
+            answer = await self.post("!room:localhost", "third")
+            self.assertEqual(answer, forbidden)
+            self.assertEqual(self.homeserver.calls["join"], 3)
+            self.assertEqual(self.homeserver.calls["send"], 5)
+        finally:
+            await self.stop_bot(bot)
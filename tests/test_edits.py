@@ -0,0 +1,52 @@
+"""Test module for alert updates sent as edits."""
+
+import json
+import unittest
+from pathlib import Path
+
+import httpx
+import nio
+
+from .start import BOT_URL, FULL_ID, MATRIX_ID, MATRIX_PW, MATRIX_URL
+
+
+class EditsTest(unittest.IsolatedAsyncioTestCase):
+    """Edits test class."""
+
+    async def test_grafana_9x_resolved(self):
+        """Send a firing alert, then resolve it, and check that it was edited."""
+        client = nio.AsyncClient(MATRIX_URL, MATRIX_ID)
+
+        await client.login(MATRIX_PW)
+        room = await client.room_create()
+
+        with Path("tests/example_grafana_9x.json").open() as f:
+            alert = json.load(f)
+        for status in ["firing", "resolved"]:
+            alert["status"] = status
+            alert["title"] = f"[{status.upper()}:1]  (TestAlert Grafana)"
+            self.assertEqual(
+                httpx.post(
+                    f"{BOT_URL}/{room.room_id}",
+                    params={"formatter": "grafana_9x"},
+                    json=alert,
+                ).json(),
+                {"status": 200, "ret": "OK"},
+            )
+
+        sync = await client.sync()
+        messages = await client.room_messages(room.room_id, sync.next_batch)
+        await client.close()
+
+        edit, first = messages.chunk[:2]
+        self.assertEqual(edit.sender, FULL_ID)
+        self.assertTrue(first.body.startswith("#### [FIRING:1]"))
+        content = edit.source["content"]
+        self.assertEqual(
+            content["m.relates_to"],
+            {"rel_type": "m.replace", "event_id": first.event_id},
+        )
+        self.assertTrue(
+            content["m.new_content"]["body"].startswith("#### [RESOLVED:1]"),
+        )
+        self.assertEqual(edit.body, f"* {content['m.new_content']['body']}")
@@ -0,0 +1,63 @@
+"""Test module for the file of alert edits."""
+
+import json
+import tempfile
+import time
+import unittest
+from pathlib import Path
+
+from matrix_webhook import conf, edits
+
+
+class EditsFileTest(unittest.TestCase):
+    """Edits file test class."""
+
+    def setUp(self):
+        """Use an edits file in a temporary directory, and an empty index."""
+        self.tmp = tempfile.TemporaryDirectory()
+        self.edits_file = conf.EDITS_FILE
+        conf.EDITS_FILE = str(Path(self.tmp.name) / "edits.json")
+        edits.INDEX.clear()
+
+    def tearDown(self):
+        """Restore the configuration, and empty the index."""
+        conf.EDITS_FILE = self.edits_file
+        edits.INDEX.clear()
+        self.tmp.cleanup()
+
+    def test_load(self):
+        """Alerts which didn't expire are loaded."""
+        later = time.time() + 60
+        entries = [
+            ["!room:localhost", "a", "$a", later, "@bot:localhost"],
+            ["!room:localhost", "b", "$b", time.time() - 60, "@bot:localhost"],
+        ]
+        Path(conf.EDITS_FILE).write_text(json.dumps(entries))
+        edits.load()
+        self.assertEqual(
+            dict(edits.INDEX),
+            {("!room:localhost", "a"): ("$a", later, "@bot:localhost")},
+        )
+
+    def test_corrupt(self):
+        """Corrupt or half written files are ignored."""
+        later = time.time() + 60
+        entry = ["!room:localhost", "a", "$a", later, "@bot:localhost"]
+        for content in [
+            json.dumps([entry])[:-10].encode(),
+            json.dumps([entry, ["!room:localhost", "b"]]).encode(),
+            json.dumps(3).encode(),
+            b"\xff",
+        ]:
+            Path(conf.EDITS_FILE).write_bytes(content)
+            with self.assertLogs("matrix_webhook.edits", "WARNING") as logs:
+                edits.load()
+            self.assertIn("Can't load alerts", logs.output[0])
+            self.assertEqual(edits.INDEX, {})
+
+    def test_unreadable(self):
+        """Files which can't be read are ignored."""
+        Path(conf.EDITS_FILE).mkdir()
+        with self.assertLogs("matrix_webhook.edits", "WARNING"):
+            edits.load()
+        self.assertEqual(edits.INDEX, {})
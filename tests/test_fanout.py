@@ -0,0 +1,70 @@
+"""Test module for messages sent to many rooms."""
+
+import unittest
+
+import httpx
+import nio
+
+from .start import BOT_URL, FULL_ID, KEY, MATRIX_ID, MATRIX_PW, MATRIX_URL
+
+
+class FanoutTest(unittest.IsolatedAsyncioTestCase):
+    """Fan-out test class."""
+
+    async def test_fanout(self):
+        """Send a message to two rooms given in the path, and check the results."""
+        body = "# Hello"
+        client = nio.AsyncClient(MATRIX_URL, MATRIX_ID)
+
+        await client.login(MATRIX_PW)
+        rooms = [(await client.room_create()).room_id for _ in range(2)]
+
+        self.assertEqual(
+            httpx.post(
+                f"{BOT_URL}/{','.join(rooms)}",
+                params={"key": KEY},
+                json={"body": body},
+            ).json(),
+            {
+                "status": 200,
+                "ret": {room: {"status": 200, "ret": "OK"} for room in rooms},
+            },
+        )
+
+        sync = await client.sync()
+        for room in rooms:
+            messages = await client.room_messages(room, sync.next_batch)
+            message = messages.chunk[0]
+            self.assertEqual(message.sender, FULL_ID)
+            self.assertEqual(message.body, body)
+            self.assertEqual(message.formatted_body, "<h1>Hello</h1>")
+        await client.close()
+
+    async def test_fanout_errors(self):
+        """Send a message to a good room and a wrong one, given as data."""
+        client = nio.AsyncClient(MATRIX_URL, MATRIX_ID)
+
+        await client.login(MATRIX_PW)
+        room = await client.room_create()
+        await client.close()
+
+        self.assertEqual(
+            httpx.post(
+                BOT_URL,
+                json={
+                    "body": "Hi",
+                    "key": KEY,
+                    "room_id": [room.room_id, "wrong_room"],
+                },
+            ).json(),
+            {
+                "status": 207,
+                "ret": {
+                    room.room_id: {"status": 200, "ret": "OK"},
+                    "wrong_room": {
+                        "status": 400,
+                        "ret": "wrong_room was not legal room ID or room alias",
+                    },
+                },
+            },
+        )
@@ -0,0 +1,49 @@
+"""Test module for rooms where the bot can't post."""
+
+import unittest
+
+import httpx
+import nio
+
+from .start import BOT_URL, FULL_ID, KEY, MATRIX_ID, MATRIX_PW, MATRIX_URL
+
+ADMIN_URL = f"{BOT_URL}/admin/forbidden-rooms"
+
+
+class ForbiddenTest(unittest.IsolatedAsyncioTestCase):
+    """Forbidden rooms test class."""
+
+    async def test_forbidden(self):
+        """Leave a private room, post there, and check the forbidden rooms."""
+        client = nio.AsyncClient(MATRIX_URL, MATRIX_ID)
+
+        await client.login(MATRIX_PW)
+        room = await client.room_create()
+        await client.room_leave(room.room_id)
+        await client.close()
+
+        results = [
+            httpx.post(
+                f"{BOT_URL}/{room.room_id}",
+                params={"key": KEY},
+                json={"body": "Hi"},
+            ).json()
+            for _ in range(2)
+        ]
+        self.assertEqual(results[0]["status"], 403)
+        self.assertEqual(results[1], results[0])
+
+        self.assertEqual(httpx.get(ADMIN_URL).json()["status"], 401)
+        rooms = httpx.get(ADMIN_URL, params={"key": KEY}).json()["rooms"]
+        self.assertEqual(rooms[room.room_id][FULL_ID]["errcode"], "M_FORBIDDEN")
+        self.assertEqual(rooms[room.room_id][FULL_ID]["failures"], 1)
+
+        self.assertEqual(
+            httpx.delete(
+                ADMIN_URL,
+                params={"key": KEY, "room_id": room.room_id},
+            ).json(),
+            {"status": 200, "ret": "OK", "forgotten": [room.room_id]},
+        )
+        rooms = httpx.get(ADMIN_URL, params={"key": KEY}).json()["rooms"]
+        self.assertNotIn(room.room_id, rooms)
@@ -0,0 +1,51 @@
+"""Test module for the forbidden rooms cache, with many accounts."""
+
+import unittest
+from http import HTTPStatus
+
+from nio.responses import RoomSendError
+
+from matrix_webhook import accounts, utils
+
+
+class ForbiddenAccountsTest(unittest.TestCase):
+    """Forbidden rooms cache test class."""
+
+    def setUp(self):
+        """Create two accounts, and an empty cache."""
+        self.banned = accounts.Account("@banned:localhost", token="token")
+        self.other = accounts.Account("@other:localhost", token="token")
+        self.resp = utils.error_response(
+            RoomSendError("You are banned from this room", "M_FORBIDDEN"),
+        )
+        utils.FORBIDDEN_ROOMS.clear()
+
+    def tearDown(self):
+        """Empty the cache."""
+        utils.FORBIDDEN_ROOMS.clear()
+
+    def test_per_account(self):
+        """An account forbidden in a room doesn't keep the others out."""
+        utils.forbid_room("!room:localhost", self.banned, self.resp)
+        resp = utils.forbidden("!room:localhost", self.banned)
+        self.assertEqual(resp.status, HTTPStatus.FORBIDDEN)
+        self.assertIsNone(utils.forbidden("!room:localhost", self.other))
+
+        rooms = utils.forbidden_rooms()
+        self.assertEqual(list(rooms), ["!room:localhost"])
+        self.assertEqual(list(rooms["!room:localhost"]), ["@banned:localhost"])
+        self.assertEqual(rooms["!room:localhost"]["@banned:localhost"]["failures"], 1)
+
+    def test_forget(self):
+        """Rooms are forgotten for every account."""
+        for account in (self.banned, self.other):
+            utils.forbid_room("!room:localhost", account, self.resp)
+        utils.forbid_room("!other:localhost", self.banned, self.resp)
+
+        self.assertEqual(
+            utils.forget_forbidden(["!room:localhost"]),
+            ["!room:localhost"],
+        )
+        self.assertEqual(list(utils.forbidden_rooms()), ["!other:localhost"])
+        self.assertEqual(utils.forget_forbidden(), ["!other:localhost"])
+        self.assertEqual(utils.forbidden_rooms(), {})
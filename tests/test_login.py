@@ -0,0 +1,70 @@
+"""Test module for logins and token refreshes, against a fake homeserver."""
+
+import asyncio
+import unittest
+
+from aiohttp import web
+
+from matrix_webhook import accounts, utils
+
+from .fake_homeserver import FakeHomeserver
+
+HOMESERVER_PORT = 4789
+
+
+class LoginTest(unittest.IsolatedAsyncioTestCase):
+    """Login test class."""
+
+    async def asyncSetUp(self):
+        """Start a fake homeserver, and an account using it."""
+        self.homeserver = FakeHomeserver(latency=50)
+        self.runner = web.AppRunner(self.homeserver.app(), access_log=None)
+        await self.runner.setup()
+        await web.TCPSite(self.runner, "localhost", HOMESERVER_PORT).start()
+        self.account = accounts.Account("@login:localhost", password="pw")
+        self.account.client.homeserver = f"http://localhost:{HOMESERVER_PORT}"
+
+    async def asyncTearDown(self):
+        """Stop the account and the fake homeserver."""
+        if self.account.refresher is not None:
+            self.account.refresher.cancel()
+        await self.account.client.close()
+        await self.runner.cleanup()
+
+    async def test_single_flight(self):
+        """Concurrent requests with the same stale token share a single login."""
+        stale = self.account.client.access_token
+        await asyncio.gather(*(utils.relogin(self.account, stale) for _ in range(10)))
+        self.assertEqual(self.homeserver.calls["login"], 1)
+        self.assertNotEqual(self.account.client.access_token, stale)
+
+        # a late request which saw the old token uses the new one
+        await utils.relogin(self.account, stale)
+        self.assertEqual(self.homeserver.calls["login"], 1)
+
+    async def test_refresh(self):
+        """Tokens are refreshed before they expire, with the same refresh token."""
+        self.homeserver.expires_ms = 200
+        await utils.login(self.account)
+        token = self.account.client.access_token
+        self.assertEqual(self.account.refresh_token, "refresh")
+
+        await asyncio.sleep(0.5)
+        # the homeserver didn't send a new refresh token, so the first one was kept
+        self.assertGreaterEqual(self.homeserver.calls["refresh"], 2)
+        self.assertEqual(self.account.refresh_token, "refresh")
+        self.assertNotEqual(self.account.client.access_token, token)
+        self.assertEqual(self.homeserver.calls["login"], 1)
+
+    async def test_refresh_error(self):
+        """A refresh answered by an HTML error page is logged, not raised."""
+        self.homeserver.expires_ms = 200
+        await utils.login(self.account)
+        token = self.account.client.access_token
+        self.homeserver.error_rate = 1
+
+        with self.assertLogs("matrix_webhook.utils", "WARNING") as logs:
+            utils.start_refresh(self.account)
+            await asyncio.gather(*utils.REFRESHES)
+        self.assertIn("Can't refresh access token", logs.output[0])
+        self.assertEqual(self.account.client.access_token, token)
@@ -0,0 +1,37 @@
+"""Test module for the Prometheus metrics endpoint."""
+
+import unittest
+
+import httpx
+
+from .start import BOT_URL, KEY, bot_req
+
+
+class MetricsTest(unittest.TestCase):
+    """Metrics test class."""
+
+    def test_metrics(self):
+        """Send a request, and check that it is counted in the metrics."""
+        self.assertEqual(
+            bot_req({"body": 3}, "wrong_key", "wrong_room"),
+            {"status": 401, "ret": "Invalid API key"},
+        )
+        self.assertEqual(
+            bot_req({"body": 3}, KEY, params={"formatter": "wrong_formatter"}),
+            {"status": 400, "ret": "Unknown formatter"},
+        )
+
+        resp = httpx.get(f"{BOT_URL}/metrics")
+        self.assertEqual(resp.status_code, 200)
+        self.assertTrue(resp.headers["content-type"].startswith("text/plain"))
+        self.assertIn("# TYPE matrix_webhook_requests_total counter", resp.text)
+        self.assertIn(
+            'matrix_webhook_requests_total{formatter="",status="401"}',
+            resp.text,
+        )
+        self.assertIn(
+            'matrix_webhook_requests_total{formatter="unknown",status="400"}',
+            resp.text,
+        )
+        self.assertIn('matrix_webhook_stage_seconds_count{stage="parse"}', resp.text)
+        self.assertIn("matrix_webhook_breaker_state 0", resp.text)
@@ -0,0 +1,73 @@
+"""Test module for the markdown cache, and the rendering of big bodies."""
+
+import threading
+import unittest
+from unittest import mock
+
+from matrix_webhook import conf, render
+
+HIT = (("result", "hit"),)
+MISS = (("result", "miss"),)
+
+
+class RenderTest(unittest.IsolatedAsyncioTestCase):
+    """Markdown rendering test class."""
+
+    def setUp(self):
+        """Start with an empty cache of 2 bodies."""
+        self.conf = conf.MARKDOWN_CACHE_SIZE, conf.MARKDOWN_THREAD_THRESHOLD
+        conf.MARKDOWN_CACHE_SIZE = 2
+        render.CACHE.clear()
+
+    def tearDown(self):
+        """Restore the configuration, and empty the cache."""
+        conf.MARKDOWN_CACHE_SIZE, conf.MARKDOWN_THREAD_THRESHOLD = self.conf
+        render.CACHE.clear()
+
+    def lookups(self):
+        """Count the hits and the misses so far."""
+        return render.LOOKUPS.values[HIT], render.LOOKUPS.values[MISS]
+
+    async def test_cache(self):
+        """Bodies are rendered once, until the least recently used are evicted."""
+        hits, misses = self.lookups()
+        self.assertEqual(await render.render("# a"), "<h1>a</h1>")
+        self.assertEqual(await render.render("# b"), "<h1>b</h1>")
+        self.assertEqual(await render.render("# a"), "<h1>a</h1>")
+        self.assertEqual(self.lookups(), (hits + 1, misses + 2))
+
+        # "b" is now the least recently used
+        self.assertEqual(await render.render("# c"), "<h1>c</h1>")
+        self.assertEqual(len(render.CACHE), 2)
+        self.assertEqual(await render.render("# a"), "<h1>a</h1>")
+        self.assertEqual(self.lookups(), (hits + 2, misses + 3))
+        self.assertEqual(await render.render("# b"), "<h1>b</h1>")
+        self.assertEqual(self.lookups(), (hits + 2, misses + 4))
+
+    async def test_no_cache(self):
+        """Nothing is kept with a cache size of 0."""
+        conf.MARKDOWN_CACHE_SIZE = 0
+        for _ in range(2):
+            self.assertEqual(await render.render("# a"), "<h1>a</h1>")
+        self.assertEqual(render.CACHE, {})
+
+    async def test_threaded(self):
+        """Big bodies are rendered in a thread, and small ones in the event loop."""
+        conf.MARKDOWN_THREAD_THRESHOLD = 100
+        threads = []
+        original = render.convert
+
+        def convert(body):
+            threads.append(threading.get_ident())
+            return original(body)
+
+        threaded = render.THREADED.values[()]
+        big = "\n".join(f"- item {i}" for i in range(100))
+        with mock.patch.object(render, "convert", side_effect=convert):
+            html = await render.render(big)
+            await render.render("small")
+        self.assertEqual(html, render.convert(big))
+        self.assertTrue(html.startswith("<ul>"))
+        self.assertEqual(render.THREADED.values[()], threaded + 1)
+        self.assertNotEqual(threads[0], threading.get_ident())
+        self.assertEqual(threads[1], threading.get_ident())
@@ -0,0 +1,66 @@
+"""Test module for messages too large for a single Matrix event."""
+
+import unittest
+
+import httpx
+import nio
+
+from matrix_webhook import split
+
+from .start import BOT_URL, FULL_ID, KEY, MATRIX_ID, MATRIX_PW, MATRIX_URL
+
+
+class SplitTest(unittest.IsolatedAsyncioTestCase):
+    """Split test class."""
+
+    async def test_split(self):
+        """Send a huge body, and check that it is delivered in several messages."""
+        body = "\n".join(
+            f"- [commit {i}](https://example.org/{i})" for i in range(3000)
+        )
+        client = nio.AsyncClient(MATRIX_URL, MATRIX_ID)
+
+        await client.login(MATRIX_PW)
+        room = await client.room_create()
+
+        self.assertEqual(
+            httpx.post(
+                f"{BOT_URL}/{room.room_id}",
+                params={"key": KEY},
+                json={"body": body},
+            ).json(),
+            {"status": 200, "ret": "OK"},
+        )
+
+        sync = await client.sync()
+        messages = await client.room_messages(room.room_id, sync.next_batch, limit=100)
+        parts = [
+            message
+            for message in reversed(messages.chunk)
+            if isinstance(message, nio.RoomMessageText)
+        ]
+        await client.close()
+
+        self.assertGreater(len(parts), 1)
+        for message in parts:
+            self.assertEqual(message.sender, FULL_ID)
+            self.assertTrue(message.formatted_body.startswith("<ul>"))
+        self.assertEqual("\n".join(message.body for message in parts), body)
+
+    async def test_fenced(self):
+        """Cut a huge fenced code block, and close it in each message."""
+        code = "\n".join(f"line {i}: {'x' * 40}" for i in range(3000))
+        body = f"Build failed:\n\n```python\n{code}\n```\n\nSee the logs."
+
+        [truncated] = await split.fit(body, "truncate")
+        self.assertGreater(len(truncated["body"]), 10000)
+        self.assertTrue(truncated["body"].startswith("Build failed:\n\n```python\n"))
+        self.assertRegex(truncated["body"], r"\n```\n\n\(\d+ more\)$")
+
+        parts = await split.fit(body)
+        self.assertGreater(len(parts), 1)
+        for part in parts:
+            self.assertEqual(part["body"].count("```"), 2)
+            self.assertIn("<pre><code", part["formatted_body"])
+        joined = "\n".join(part["body"] for part in parts)
+        self.assertEqual(joined.replace("\n```\n```python\n", "\n"), body)
@@ -0,0 +1,117 @@
+"""Test module for many worker processes, against a fake homeserver."""
+
+import asyncio
+import os
+import signal
+import time
+import unittest
+from pathlib import Path
+
+import httpx
+from aiohttp import web
+
+from .fake_homeserver import FakeHomeserver
+
+KEY = "fake"
+BOT_URL = "http://localhost:4790"
+HOMESERVER_PORT = 4791
+
+
+def children(pid):
+    """Get the pids of the child processes of a process."""
+    path = Path(f"/proc/{pid}/task/{pid}/children")
+    return [int(child) for child in path.read_text().split()]
+
+
+class WorkersTest(unittest.IsolatedAsyncioTestCase):
+    """Worker processes test class."""
+
+    async def asyncSetUp(self):
+        """Start a fake homeserver, and a supervisor with 2 workers using it."""
+        self.homeserver = FakeHomeserver()
+        self.runner = web.AppRunner(self.homeserver.app(), access_log=None)
+        await self.runner.setup()
+        await web.TCPSite(self.runner, "localhost", HOMESERVER_PORT).start()
+        self.client = httpx.AsyncClient(base_url=BOT_URL, params={"key": KEY})
+        self.bot = await asyncio.create_subprocess_exec(
+            "python",
+            "-m",
+            "matrix_webhook",
+            "--port=4790",
+            f"--api-key={KEY}",
+            f"--matrix-url=http://localhost:{HOMESERVER_PORT}",
+            "--matrix-id=@fake:localhost",
+            "--matrix-pw=fake",
+            "--workers=2",
+            "--async-delivery",
+        )
+        if not await self.available():
+            self.fail("matrix_webhook did not start")
+
+    async def asyncTearDown(self):
+        """Stop the supervisor, and the fake homeserver."""
+        if self.bot.returncode is None:
+            self.bot.terminate()
+            await self.bot.wait()
+        await self.client.aclose()
+        await self.runner.cleanup()
+
+    async def available(self, timeout=10):
+        """Wait until the workers answer."""
+        start = time.monotonic()
+        while time.monotonic() < start + timeout:
+            try:
+                if (await self.client.get("/health")).status_code == 200:
+                    return True
+            except httpx.TransportError:
+                pass
+            await asyncio.sleep(0.1)
+        return False
+
+    async def post_all(self, bodies, room_id="!workers:localhost"):
+        """Send webhooks to the workers at once, and check they are accepted."""
+        answers = await asyncio.gather(
+            *(self.client.post(f"/{room_id}", json={"body": body}) for body in bodies),
+        )
+        self.assertEqual(
+            [answer.json() for answer in answers],
+            [{"status": 202, "ret": "Accepted"}] * len(bodies),
+        )
+
+    async def test_drain(self):
+        """Workers share a single login, and deliver what they accepted on SIGTERM."""
+        # slow enough for messages to wait in the queues
+        self.homeserver.latency = 0.05
+        bodies = [f"message {i}" for i in range(20)]
+        await self.post_all(bodies)
+        self.bot.send_signal(signal.SIGTERM)
+        self.assertEqual(await asyncio.wait_for(self.bot.wait(), 20), 0)
+
+        self.assertEqual(self.homeserver.calls["login"], 1)
+        self.assertEqual(
+            sorted(body for _, body in self.homeserver.messages),
+            sorted(bodies),
+        )
+
+    async def test_restart(self):
+        """A crashed worker is restarted, and takes the access token of the others."""
+        await self.post_all(["before"] * 10)
+        # without an outbox, the queue of a killed worker is lost
+        start = time.monotonic()
+        while len(self.homeserver.messages) < 10:
+            self.assertLess(time.monotonic(), start + 10)
+            await asyncio.sleep(0.1)
+        workers = children(self.bot.pid)
+        self.assertEqual(len(workers), 2)
+
+        os.kill(workers[0], signal.SIGKILL)
+        start = time.monotonic()
+        while len(set(children(self.bot.pid)) - {workers[0]}) < 2:
+            self.assertLess(time.monotonic(), start + 10)
+            await asyncio.sleep(0.1)
+
+        await self.post_all(["after"] * 10)
+        self.bot.send_signal(signal.SIGTERM)
+        self.assertEqual(await asyncio.wait_for(self.bot.wait(), 20), 0)
+        self.assertEqual(self.homeserver.calls["login"], 1)
+        self.assertEqual(len(self.homeserver.messages), 20)
@@ -2,9 +2,10 @@
 
 import unittest
 
+import httpx
 import nio
 
-from .start import FULL_ID, KEY, MATRIX_ID, MATRIX_PW, MATRIX_URL, bot_req
+from .start import BOT_URL, FULL_ID, KEY, MATRIX_ID, MATRIX_PW, MATRIX_URL, bot_req
 
 
 class BotTest(unittest.IsolatedAsyncioTestCase):
@@ -29,6 +30,24 @@ class BotTest(unittest.IsolatedAsyncioTestCase):
             bot_req({"body": 3}, KEY, params={"formatter": "wrong_formatter"}),
             {"status": 400, "ret": "Unknown formatter"},
         )
+        self.assertEqual(
+            bot_req({"body": 3}, KEY, params={"formatter": "re"}),
+            {"status": 400, "ret": "Unknown formatter"},
+        )
+        self.assertEqual(
+            bot_req({"body": "x" * 1024**2}, KEY, "wrong_room"),
+            {"status": 413, "ret": "Payload too large"},
+        )
+        # wrong keys in headers are rejected before reading the body too
+        self.assertEqual(
+            httpx.post(
+                f"{BOT_URL}/wrong_room",
+                params={"formatter": "gitlab_webhook"},
+                headers={"X-Gitlab-Token": "wrong_key"},
+                content="x" * 1024**2,
+            ).json(),
+            {"status": 401, "ret": "Invalid API key"},
+        )
         # TODO: if the client from matrix_webhook has olm support,
         # this won't be a 403 from synapse, but a LocalProtocolError from matrix_webhook
         self.assertEqual(
@@ -174,4 +193,7 @@ class BotTest(unittest.IsolatedAsyncioTestCase):
 
     async def test_healthcheck(self):
         """Check the healthcheck endpoint returns 200."""
-        self.assertEqual(bot_req(room_id="health"), {"status": 200, "ret": "OK"})
+        self.assertEqual(
+            bot_req(room_id="health"),
+            {"status": 200, "ret": "OK", "breaker": "closed"},
+        )